@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""Benchmark conversion of synthetic GTFS feeds phase by phase.
+
+Synthetic GTFS feeds of several sizes are generated, converted into JSON and the time and memory
+of each phase of gtfs2json_gtfs.get_routes(), polyline.encode() and gtfs2json_json.create() are
+reported (see phase_metrics). SHA-256 digests of the JSON outputs (with json_epoch zeroed) can
+be saved into and checked against a golden file to prove that an optimization does not change
+the output.
+
+Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
+"""
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import tracemalloc
+import zipfile
+
+import gtfs2json_gtfs
+import gtfs2json_json
+import phase_metrics
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routes', type=int, default=20, help='Number of routes at scale 1')
+    parser.add_argument('--trips', type=int, default=30, help='Number of trips per route')
+    parser.add_argument('--stops', type=int, default=25, help='Number of stops per trip')
+    parser.add_argument('--shape-points', type=int, default=200,
+                        help='Number of points per shape')
+    parser.add_argument('--exceptions', type=int, default=4,
+                        help='Number of calendar exceptions per service')
+    parser.add_argument('--patterns', type=int, default=2,
+                        help='Number of stop patterns per route, trips share them')
+    parser.add_argument('--shared-patterns', type=int, default=2,
+                        help='Number of stop patterns (and shapes) shared by all routes')
+    parser.add_argument('--scales', default='1,4,16',
+                        help='Comma separated multipliers of number of routes')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of random generator')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Measure peak memory of each phase with tracemalloc (slow)')
+    parser.add_argument('--golden', help='JSON file of golden output digests')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='Save output digests into golden file instead of checking them')
+    parser.add_argument('--results', help='Save results into JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='benchmark.log', level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(filename)s:%(lineno)d '
+                               '%(funcName)s: %(message)s')
+
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        feed_params = {
+            'routes': args.routes * scale,
+            'trips': args.trips,
+            'stops': args.stops,
+            'shape_points': args.shape_points,
+            'exceptions': args.exceptions,
+            'patterns': args.patterns,
+            'shared_patterns': args.shared_patterns,
+            'seed': args.seed
+        }
+        results.append(_benchmark_feed(feed_params, args.trace_memory))
+        _print_result(results[-1])
+
+    is_ok = True
+    if args.golden:
+        if args.update_golden:
+            _save_golden(args.golden, results)
+        else:
+            is_ok = _check_golden(args.golden, results)
+    if args.results:
+        with open(args.results, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if not is_ok:
+        sys.exit(1)
+
+
+def _get_feed_name(feed_params):
+    return ('r{routes}_t{trips}_s{stops}_p{shape_points}_e{exceptions}_x{patterns}'
+            '_y{shared_patterns}_{seed}').format(**feed_params)
+
+
+def create_feed(output_zip, feed_params):
+    """Create synthetic GTFS ZIP file and return its shape points by shape_id. Each route has
+    feed_params['patterns'] stop patterns (each with its own shape) and the stop patterns shared
+    by all routes, the trips of route are distributed among them."""
+    rnd = random.Random(feed_params['seed'])
+    files = {}  # CSV contents by filename
+    shapes = {}
+    services = ['service_{}'.format(i) for i in range(8)]
+
+    calendar_rows = []
+    calendar_date_rows = []
+    for i, service_id in enumerate(services):
+        weekdays = ['1' if rnd.random() < 0.6 else '0' for _ in range(7)]
+        calendar_rows.append([service_id] + weekdays + ['2024{:02d}01'.format(1 + (i % 6)),
+                                                        '2024{:02d}28'.format(7 + (i % 5))])
+        for _ in range(feed_params['exceptions']):
+            calendar_date_rows.append([service_id, '2024{:02d}{:02d}'.format(
+                rnd.randrange(1, 13), rnd.randrange(1, 29)), rnd.choice(['1', '2'])])
+
+    stop_rows = []
+    shape_rows = []
+    route_rows = []
+    trip_rows = []
+    stop_time_rows = []
+    shared_patterns = [_add_pattern(rnd, feed_params, 'shared', pattern_i, stop_rows, shape_rows,
+                                    shapes)
+                       for pattern_i in range(feed_params['shared_patterns'])]
+    for route_i in range(feed_params['routes']):
+        route_id = 'route_{}'.format(route_i)
+        route_rows.append([route_id, 'agency_{}'.format(route_i % 3), str(route_i),
+                           'Route {}'.format(route_i), rnd.choice(['0', '1', '3', '4', '109'])])
+        patterns = [_add_pattern(rnd, feed_params, route_i, pattern_i, stop_rows, shape_rows,
+                                 shapes)
+                    for pattern_i in range(feed_params['patterns'])] + shared_patterns
+        for trip_i in range(feed_params['trips']):
+            (shape_id, stop_ids) = patterns[trip_i % len(patterns)]
+            trip_id = '{}_trip_{}'.format(route_id, trip_i)
+            trip_rows.append([route_id, rnd.choice(services), trip_id, str(trip_i % 2), shape_id])
+            seconds = (5 * 3600) + (rnd.randrange(18 * 60) * 60)
+            for stop_i, stop_id in enumerate(stop_ids):
+                time_string = _get_time_string(seconds)
+                stop_time_rows.append([trip_id, time_string, time_string, stop_id, stop_i + 1])
+                seconds += 60 * rnd.randrange(1, 4)
+
+    _add_csv_file(files, 'stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], stop_rows)
+    _add_csv_file(files, 'shapes.txt',
+                  ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], shape_rows)
+    _add_csv_file(files, 'routes.txt', ['route_id', 'agency_id', 'route_short_name',
+                                        'route_long_name', 'route_type'], route_rows)
+    _add_csv_file(files, 'trips.txt',
+                  ['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id'], trip_rows)
+    _add_csv_file(files, 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time',
+                                            'stop_id', 'stop_sequence'], stop_time_rows)
+    _add_csv_file(files, 'calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday',
+                                          'thursday', 'friday', 'saturday', 'sunday',
+                                          'start_date', 'end_date'], calendar_rows)
+    _add_csv_file(files, 'calendar_dates.txt', ['service_id', 'date', 'exception_type'],
+                  calendar_date_rows)
+
+    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for filename, content in files.items():
+            zip_info = zipfile.ZipInfo(filename, (2024, 1, 1, 0, 0, 0))
+            zip_file.writestr(zip_info, content, zipfile.ZIP_DEFLATED)
+    return shapes
+
+
+def _add_pattern(rnd, feed_params, route_i, pattern_i, stop_rows, shape_rows, shapes):
+    """Add shape and stops of one stop pattern of route, stops are along the shape."""
+    shape_id = 'shape_{}_{}'.format(route_i, pattern_i)
+    shapes[shape_id] = []
+    (lat0, lng0) = (60 + rnd.random(), 24 + rnd.random())
+    points = []
+    for point_i in range(feed_params['shape_points']):
+        distance = point_i / feed_params['shape_points']
+        point = (lat0 + (distance * 0.1) + (0.001 * math.sin((point_i * 0.3) + pattern_i)),
+                 lng0 + (distance * 0.1) + (0.001 * math.cos(point_i * 0.2)))
+        points.append(point)
+        shape_rows.append([shape_id, '{:.6f}'.format(point[0]), '{:.6f}'.format(point[1]),
+                           point_i + 1])
+        shapes[shape_id].append((float(shape_rows[-1][1]), float(shape_rows[-1][2])))
+
+    stop_ids = []
+    for stop_i in range(feed_params['stops']):
+        stop_id = 'stop_{}_{}_{}'.format(route_i, pattern_i, stop_i)
+        point = points[_get_stop_point_index(feed_params, stop_i)]
+        stop_rows.append([stop_id, 'Stop {}'.format(stop_i), '{:.6f}'.format(point[0] + 0.00005),
+                          '{:.6f}'.format(point[1] - 0.00004)])
+        stop_ids.append(stop_id)
+
+    return (shape_id, stop_ids)
+
+
+def _get_stop_point_index(feed_params, stop_i):
+    return (stop_i * (feed_params['shape_points'] - 1)) // max(1, feed_params['stops'] - 1)
+
+
+def _get_time_string(seconds):
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def _add_csv_file(files, filename, header, rows):
+    output = io.StringIO()
+    csv_writer = csv.writer(output, lineterminator='\n')
+    csv_writer.writerow(header)
+    csv_writer.writerows(rows)
+    files[filename] = output.getvalue()
+
+
+def _benchmark_feed(feed_params, trace_memory):
+    """Convert synthetic feed and measure each phase of conversion."""
+    feed_name = _get_feed_name(feed_params)
+    metrics = phase_metrics.create(feed_name, feed_params=feed_params)
+    print('benchmarking {}...'.format(feed_name))
+    if trace_memory:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gtfs_zip = os.path.join(temp_dir, 'gtfs.zip')
+        output_json = os.path.join(temp_dir, 'gtfs.json')
+        with phase_metrics.measure(metrics, 'create_feed'):
+            shapes = create_feed(gtfs_zip, feed_params)
+        metrics['info']['gtfs_bytes'] = os.path.getsize(gtfs_zip)
+
+        with gtfs2json_gtfs.open_feed(gtfs_zip) as feed, contextlib.redirect_stdout(None):
+            routes = gtfs2json_gtfs.get_routes(feed, 1, None, metrics)
+            gtfs_modification_time = gtfs2json_gtfs.get_modification_time(feed)
+        with phase_metrics.measure(metrics, 'polyline.encode') as phase:
+            phase['count'] = _encode_shapes(shapes, feed_params)
+        gtfs2json_json.create_files(routes, [{'filename': output_json, 'route_ids': list(routes)}],
+                                    gtfs_modification_time, 1, metrics)
+
+        metrics['info']['json_bytes'] = os.path.getsize(output_json)
+        metrics['info']['json_sha256'] = _get_output_digest(output_json)
+
+    if trace_memory:
+        tracemalloc.stop()
+    return phase_metrics.get_summary(metrics)
+
+
+def _encode_shapes(shapes, feed_params):
+    """Encode all shapes of feed with stop points as fixed points."""
+    fixed_indexes = sorted(set(_get_stop_point_index(feed_params, stop_i)
+                               for stop_i in range(feed_params['stops'])))
+    for points in shapes.values():
+        gtfs2json_gtfs.encode_shape(points, fixed_indexes)
+    return len(shapes)
+
+
+def _get_output_digest(output_json):
+    """Get SHA-256 digest of JSON output with json_epoch (creation time) zeroed."""
+    with open(output_json, 'rb') as input_file:
+        content = input_file.read()
+    # root is [array_keys, gtfs_epoch, json_epoch, ...], array_keys is dict of dicts
+    content = re.sub(rb'^(\[\{.*?\}\},-?\d+,)\d+,', rb'\g<1>0,', content, count=1)
+    return hashlib.sha256(content).hexdigest()
+
+
+def _print_result(result):
+    seconds = sum(phase['seconds'] for phase in result['phases'] if phase['name'] != 'create_feed')
+    print('{}: {} GTFS bytes, {} JSON bytes, {:.2f} seconds'.format(
+        result['name'], result['info']['gtfs_bytes'], result['info']['json_bytes'], seconds))
+    for phase in result['phases']:
+        peak = ''
+        if 'traced_peak_mb' in phase:
+            peak = ' {:8.1f} MB peak'.format(phase['traced_peak_mb'])
+        print('  {:25} {:8} {:8.3f} s {:8.3f} cpu s {:8.1f} MB max rss{}'.format(
+            phase['name'], phase['count'] or '', phase['seconds'], phase['cpu_seconds'],
+            phase['max_rss_mb'], peak))
+
+
+def _save_golden(golden_filename, results):
+    golden = {}
+    if os.path.isfile(golden_filename):
+        with open(golden_filename) as input_file:
+            golden = json.load(input_file)
+    for result in results:
+        golden[result['name']] = result['info']['json_sha256']
+    with open(golden_filename, 'w') as output_file:
+        json.dump(golden, output_file, indent=2, sort_keys=True)
+    print('saved {} digests into {}'.format(len(results), golden_filename))
+
+
+def _check_golden(golden_filename, results):
+    with open(golden_filename) as input_file:
+        golden = json.load(input_file)
+    is_ok = True
+    for result in results:
+        if result['name'] not in golden:
+            print('{}: no golden digest'.format(result['name']))
+            is_ok = False
+        elif golden[result['name']] != result['info']['json_sha256']:
+            print('{}: output differs from golden output'.format(result['name']))
+            is_ok = False
+        else:
+            print('{}: output matches golden output'.format(result['name']))
+    return is_ok
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,120 @@
+"""Write values (None, bool, int, float, str, list, dict and integer arrays) in compact
+binary format, decoded by decodeGtfsBinary() in ui/js/gtfs.js.
+
+File starts with magic b'GTFB', version (byte) and offset of string table (uint32, little-endian)
+followed by one value and the string table. Each value is a tag byte and its data:
+TAG_INTEGER is zigzag varint, TAG_FLOAT is float64 (little-endian), TAG_STRING is varint index
+in string table, TAG_LIST is varint number of items and the items, TAG_OPEN_LIST is items ending
+with TAG_END (so that list can be written before its length is known), TAG_DICT is varint number
+of items and string index of key and value of each item and TAG_INTEGER_ARRAY (array.array) is
+varint number of integers and zigzag varint of each integer. String table is varint number of
+strings and varint byte length and UTF-8 bytes of each string.
+
+Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
+"""
+
+import array
+import struct
+
+import interning
+
+MAGIC = b'GTFB'
+VERSION = 1
+
+TAG_NULL = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INTEGER = 3
+TAG_FLOAT = 4
+TAG_STRING = 5
+TAG_LIST = 6
+TAG_OPEN_LIST = 7
+TAG_END = 8
+TAG_DICT = 9
+TAG_INTEGER_ARRAY = 10
+
+_HEADER = struct.Struct('<4sBI')
+
+
+def open_writer(filename):
+    """Open binary file for writing with write_value(), start_open_list() and end_open_list().
+    Strings are collected into string table written by close_writer()."""
+    writer = {'file': open(filename, 'wb'), 'strings': interning.create()}
+    writer['file'].write(_HEADER.pack(MAGIC, VERSION, 0))
+    return writer
+
+
+def write_value(writer, value):
+    output = bytearray()
+    _add_value(output, writer['strings'], value)
+    writer['file'].write(output)
+
+
+def start_open_list(writer):
+    writer['file'].write(bytes([TAG_OPEN_LIST]))
+
+
+def end_open_list(writer):
+    writer['file'].write(bytes([TAG_END]))
+
+
+def close_writer(writer):
+    """Write string table and its offset into header and close file."""
+    string_table_offset = writer['file'].tell()
+    output = bytearray()
+    _add_varint(output, len(writer['strings']['values']))
+    for string in writer['strings']['values']:
+        encoded_string = string.encode('utf-8')
+        _add_varint(output, len(encoded_string))
+        output += encoded_string
+    writer['file'].write(output)
+    writer['file'].seek(0)
+    writer['file'].write(_HEADER.pack(MAGIC, VERSION, string_table_offset))
+    writer['file'].close()
+
+
+def _add_value(output, strings, value):
+    if value is None:
+        output.append(TAG_NULL)
+    elif value is False:
+        output.append(TAG_FALSE)
+    elif value is True:
+        output.append(TAG_TRUE)
+    elif isinstance(value, int):
+        output.append(TAG_INTEGER)
+        _add_varint(output, _zigzag(value))
+    elif isinstance(value, float):
+        output.append(TAG_FLOAT)
+        output += struct.pack('<d', value)
+    elif isinstance(value, str):
+        output.append(TAG_STRING)
+        _add_varint(output, interning.get_index(strings, value))
+    elif isinstance(value, array.array):
+        output.append(TAG_INTEGER_ARRAY)
+        _add_varint(output, len(value))
+        for integer in value:
+            _add_varint(output, _zigzag(integer))
+    elif isinstance(value, (list, tuple)):
+        output.append(TAG_LIST)
+        _add_varint(output, len(value))
+        for item in value:
+            _add_value(output, strings, item)
+    elif isinstance(value, dict):
+        output.append(TAG_DICT)
+        _add_varint(output, len(value))
+        for key, item in value.items():
+            _add_varint(output, interning.get_index(strings, key))
+            _add_value(output, strings, item)
+    else:
+        raise SystemExit('unsupported value type: {}'.format(type(value)))
+
+
+def _zigzag(integer):
+    return (integer << 1) if integer >= 0 else ((-integer << 1) - 1)
+
+
+def _add_varint(output, integer):
+    while integer >= 0x80:
+        output.append((integer & 0x7F) | 0x80)
+        integer >>= 7
+    output.append(integer)
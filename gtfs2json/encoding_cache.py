@@ -0,0 +1,96 @@
+"""Cache encoded shapes on disk between runs.
+
+Entries are keyed by content hash of shape points, stop points and encoding tolerance, so they
+stay valid across GTFS versions as long as geometry does not change. Each entry is its own file
+which makes the cache safe to use from parallel processes. Least recently used entries are
+deleted when the cache grows over its maximum size.
+
+Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
+"""
+
+import array
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+_VERSION = 1  # increase when encoding or stop distances change
+
+
+def create(cache_dir, max_size_mb):
+    """Create shape cache in cache_dir."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return {'dir': cache_dir, 'max_size': max_size_mb * 1024 * 1024}
+
+
+def get_key(shape, stop_points, very_small):
+    """Get key of shape (list of points) with stop_points (list of points) encoded using
+    very_small."""
+    key_hash = hashlib.sha256()
+    key_hash.update(array.array('d', [_VERSION, very_small, len(shape), len(stop_points)]))
+    key_hash.update(array.array('d', [value for point in shape for value in point]))
+    key_hash.update(array.array('d', [value for point in stop_points for value in point]))
+    return key_hash.hexdigest()
+
+
+def get(shape_cache, key):
+    """Get cached value of key or None if key is not in cache."""
+    path = _get_path(shape_cache, key)
+    try:
+        with open(path, 'rb') as cache_file:
+            value = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    try:
+        os.utime(path)  # mark as recently used
+    except OSError:
+        pass
+    return value
+
+
+def put(shape_cache, key, value):
+    """Add value of key into cache."""
+    path = _get_path(shape_cache, key)
+    entry_dir = os.path.dirname(path)
+    if not os.path.isdir(entry_dir):
+        os.makedirs(entry_dir, exist_ok=True)
+    temp_file, temp_filename = tempfile.mkstemp(dir=entry_dir)
+    with os.fdopen(temp_file, 'wb') as cache_file:
+        pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, path)  # atomic, readers see either old or new entry
+
+
+def evict(shape_cache):
+    """Delete least recently used entries until cache is not larger than its maximum size. Cache
+    may be shared by parallel conversions, so entries may disappear while evicting."""
+    entries = []
+    total_size = 0
+    for entry_dir, _, filenames in os.walk(shape_cache['dir']):
+        for filename in filenames:
+            path = os.path.join(entry_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+    num_deleted = 0
+    for _, size, path in sorted(entries):
+        if total_size <= shape_cache['max_size']:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        num_deleted += 1
+
+    logging.debug('shape cache: {} entries, {} bytes, deleted {} entries'.format(
+        len(entries) - num_deleted, total_size, num_deleted))
+
+
+def _get_path(shape_cache, key):
+    return os.path.join(shape_cache['dir'], key[:2], key)
@@ -2,22 +2,48 @@
 
 """Download GTFS file and generate JSON file.
 
+Configuration is either one feed (see generate_example.json) or several feeds in 'feeds' with
+common feed settings and scheduling settings (see generate_multi_example.json). Feeds are
+downloaded concurrently and converted smallest first in parallel, within 'max_jobs' (default: number
+of CPUs) and 'memory_budget_mb' (estimated from size of GTFS file unless feed has 'memory_mb').
+
 Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
 """
 
 import argparse
+import concurrent.futures
 import datetime
+import gzip
 import hashlib
+import http.client
 import json
 import logging
 import os
 import re
 import resource
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.error
+import urllib.request
 import zipfile
+import zlib
+
+try:
+    import brotli  # optional, see _create_hashed_files()
+except ImportError:
+    brotli = None
+
+import phase_metrics
+
+_DOWNLOAD_TIMEOUT = 60  # seconds, for connecting and each read
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+_DOWNLOAD_JOBS = 4
+_BASE_MEMORY_MB = 20  # memory estimate of conversion is _BASE_MEMORY_MB + size of GTFS file ...
+_MEMORY_MB_PER_GTFS_MB = 15  # ... in megabytes * _MEMORY_MB_PER_GTFS_MB
 
 
 def _main():
@@ -33,20 +59,184 @@ def _main():
     logging.debug('started {}'.format(sys.argv))
 
     config = _load_config(args.config)
+    feed_configs = _get_feed_configs(config)
+    # CPU time and memory of process are per feed only if there is one feed
+    feed_runs = [{'config': feed_config, 'status': None, 'error': None, 'seconds': {},
+                  'metrics': phase_metrics.create('generate', len(feed_configs) == 1,
+                                                  argv=sys.argv, feed=feed_config['name'])}
+                 for feed_config in feed_configs]
+
+    with concurrent.futures.ThreadPoolExecutor(min(len(feed_runs), _DOWNLOAD_JOBS)) as executor:
+        list(executor.map(_download_feed, feed_runs))
+    _convert_feeds([feed_run for feed_run in feed_runs if feed_run['status'] == 'downloaded'],
+                   args, config.get('max_jobs', os.cpu_count()), config.get('memory_budget_mb'))
+    for feed_run in feed_runs:
+        _finish_feed(feed_run)
+    _save_summary(feed_runs, config.get('metrics_dir') if 'feeds' in config else None)
 
+    logging.debug('took {} seconds, max mem: {} megabytes'.format(
+        int(time.time() - start_time), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    failed_names = [feed_run['config']['name'] for feed_run in feed_runs if feed_run['error']]
+    if failed_names:
+        raise SystemExit('failed feeds: {}'.format(', '.join(failed_names)))
+
+
+def _get_feed_configs(config):
+    """Get config of each feed, settings of multi-feed config are defaults of its feeds."""
+    if 'feeds' not in config:
+        return [config]
+    if not config['feeds']:
+        raise SystemExit('no feeds in config')
+    feed_configs = []
+    for feed in config['feeds']:
+        feed_config = {key: value for key, value in config.items()
+                       if key not in ['feeds', 'max_jobs', 'memory_budget_mb']}
+        feed_config.update(feed)
+        feed_configs.append(feed_config)
+    return feed_configs
+
+
+def _download_feed(feed_run):
+    config = feed_run['config']
+    _FEED_THREAD.name = config['name']
+    feed_run['download_state_file'] = config.get('download_state_file', os.path.join(
+        config['gtfs_dir'], '{}_download_state.json'.format(config['name'])))
+    feed_run['metrics']['info']['is_new_gtfs'] = False
+    start_time = time.perf_counter()
+    try:
+        download_state = _load_download_state(feed_run['download_state_file'], config['url'])
+        with phase_metrics.measure(feed_run['metrics'], 'download_gtfs'):
+            feed_run['downloaded_gtfs_zip'], feed_run['download_state'] = _download_gtfs(
+                config['url'], download_state)
+    except (SystemExit, Exception) as error:
+        _set_feed_failed(feed_run, error)
+    else:
+        feed_run['status'] = 'downloaded' if feed_run['downloaded_gtfs_zip'] else 'not_modified'
+    feed_run['seconds']['download'] = round(time.perf_counter() - start_time, 3)
+
+
+def _convert_feeds(feed_runs, args, max_jobs, memory_budget_mb):
+    """Convert downloaded feeds smallest first, each in its own thread. Next feed is started when
+    less than max_jobs feeds are being converted and estimated memory of feeds being converted
+    fits into memory_budget_mb (but always if no feed is being converted)."""
+    for feed_run in feed_runs:
+        gtfs_size_mb = os.path.getsize(feed_run['downloaded_gtfs_zip']) / (1024 * 1024)
+        feed_run['memory_mb'] = feed_run['config'].get(
+            'memory_mb', round(_BASE_MEMORY_MB + (gtfs_size_mb * _MEMORY_MB_PER_GTFS_MB), 1))
+        feed_run['gtfs_size_mb'] = round(gtfs_size_mb, 1)
+    pool = {'condition': threading.Condition(), 'jobs': 0, 'memory_mb': 0}
+    threads = []
+    for feed_run in sorted(feed_runs, key=lambda feed_run: feed_run['gtfs_size_mb']):
+        start_time = time.perf_counter()
+        with pool['condition']:
+            while not _is_room_in_pool(pool, max_jobs, memory_budget_mb, feed_run['memory_mb']):
+                pool['condition'].wait()
+            pool['jobs'] += 1
+            pool['memory_mb'] += feed_run['memory_mb']
+        feed_run['seconds']['wait'] = round(time.perf_counter() - start_time, 3)
+        thread = threading.Thread(target=_convert_feed, args=(pool, feed_run, args))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def _is_room_in_pool(pool, max_jobs, memory_budget_mb, memory_mb):
+    if pool['jobs'] == 0:
+        return True
+    if pool['jobs'] >= max_jobs:
+        return False
+    return (memory_budget_mb is None) or (pool['memory_mb'] + memory_mb <= memory_budget_mb)
+
+
+def _convert_feed(pool, feed_run, args):
+    """Convert feed in its own thread, feed is released from pool whatever happens so that
+    waiting feeds are not blocked."""
+    _FEED_THREAD.name = feed_run['config']['name']
+    start_time = time.perf_counter()
+    try:
+        _generate(feed_run['config'], args, feed_run['metrics'], feed_run['downloaded_gtfs_zip'])
+    except (SystemExit, Exception) as error:
+        _set_feed_failed(feed_run, error)
+    else:
+        is_new_gtfs = feed_run['metrics']['info']['is_new_gtfs']
+        feed_run['status'] = 'converted' if is_new_gtfs else 'identical'
+    finally:
+        feed_run['seconds']['convert'] = round(time.perf_counter() - start_time, 3)
+        with pool['condition']:
+            pool['jobs'] -= 1
+            pool['memory_mb'] -= feed_run['memory_mb']
+            pool['condition'].notify_all()
+
+
+def _set_feed_failed(feed_run, error):
+    """Mark feed failed with its error (called in except block), other feeds are still
+    processed."""
+    if isinstance(error, SystemExit):
+        feed_run['error'] = str(error)
+    else:
+        logging.exception('unexpected error in feed {}'.format(feed_run['config']['name']))
+        feed_run['error'] = repr(error)
+    _progress_warning(feed_run['error'])
+    feed_run['status'] = 'failed'
+
+
+def _finish_feed(feed_run):
+    """Save download state and metrics of feed. If feed failed, download state is not saved (so
+    that GTFS file is downloaded again next time) and downloaded file is deleted."""
+    config = feed_run['config']
+    if feed_run['error'] is None:
+        _save_download_state(feed_run['download_state_file'], feed_run['download_state'])
+    elif feed_run.get('downloaded_gtfs_zip') and os.path.isfile(feed_run['downloaded_gtfs_zip']):
+        os.remove(feed_run['downloaded_gtfs_zip'])
+    if 'metrics_dir' in config:
+        _create_dir(config['metrics_dir'])
+        metrics_file = 'generate_{}_{}.json'.format(config['name'], _get_now_timestamp())
+        phase_metrics.save(feed_run['metrics'], os.path.join(config['metrics_dir'], metrics_file))
+
+
+def _save_summary(feed_runs, metrics_dir):
+    """Log status and timings of each feed and save them into metrics_dir (if not None)."""
+    summary = []
+    for feed_run in feed_runs:
+        feed_summary = {'name': feed_run['config']['name'], 'status': feed_run['status'],
+                        'seconds': feed_run['seconds']}
+        for key in ['gtfs_size_mb', 'memory_mb', 'error']:
+            if feed_run.get(key) is not None:
+                feed_summary[key] = feed_run[key]
+        summary.append(feed_summary)
+        _progress('{}: {} {}'.format(feed_summary['name'], feed_summary['status'],
+                                     feed_summary['seconds']))
+    if metrics_dir:
+        _create_dir(metrics_dir)
+        summary_file = os.path.join(metrics_dir,
+                                    'generate_summary_{}.json'.format(_get_now_timestamp()))
+        with open(summary_file, 'w') as output_file:
+            json.dump(summary, output_file, indent=2)
+
+
+def _generate(config, args, metrics, downloaded_gtfs_zip):
     gtfs_name = config['name']
-    downloaded_gtfs_zip = _download_gtfs(config['url'])
-    modify_date = _get_modify_date(downloaded_gtfs_zip)
-    gtfs_dir = _get_q_dir(config['gtfs_dir'], modify_date, not args.use_no_q_dirs)
-    gtfs_zip = _rename_gtfs_zip(gtfs_dir, downloaded_gtfs_zip, gtfs_name, modify_date)
+    with phase_metrics.measure(metrics, 'rename_gtfs_zip'):
+        modify_date = _get_modify_date(downloaded_gtfs_zip)
+        gtfs_dir = _get_q_dir(config['gtfs_dir'], modify_date, not args.use_no_q_dirs)
+        gtfs_zip = _rename_gtfs_zip(gtfs_dir, downloaded_gtfs_zip, gtfs_name, modify_date)
+    metrics['info']['modify_date'] = modify_date
+    metrics['info']['is_new_gtfs'] = gtfs_zip is not None
     if gtfs_zip and (not args.only_download):
         log_dir = _get_q_dir(config['log_dir'], modify_date, not args.use_no_q_dirs)
-        _generate_json(gtfs_name, modify_date, gtfs_zip, config['json_dir'], log_dir)
+        with phase_metrics.measure(metrics, 'generate_json') as phase:
+            date_output_file, rusage = _generate_json(gtfs_name, modify_date, gtfs_zip,
+                                                      config['json_dir'], log_dir,
+                                                      config.get('shape_cache_dir'),
+                                                      config.get('metrics_dir'))
+            phase_metrics.add_child_usage(phase, rusage)
+        if 'hashed_json_dir' in config:
+            with phase_metrics.measure(metrics, 'create_hashed_files'):
+                _create_hashed_files(date_output_file, config['hashed_json_dir'], gtfs_name)
         if 'json_bu_dir' in config:
-            _move_old_json_files_to_bu_dir(config['json_dir'], config['json_bu_dir'])
-
-    logging.debug('took {} seconds, max mem: {} megabytes'.format(
-        int(time.time() - start_time), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+            with phase_metrics.measure(metrics, 'move_old_json_files'):
+                _move_old_json_files_to_bu_dir(config['json_dir'], config['json_bu_dir'])
 
 
 def _init_logging():
@@ -54,34 +244,123 @@ def _init_logging():
     logging.basicConfig(filename='generate.log', format=log_format, level=logging.DEBUG)
 
 
+_FEED_THREAD = threading.local()  # name of feed processed by thread, prefix of its progress
+
+
 def _progress(text):
+    text = _get_feed_prefix() + text
     print(text)
     logging.debug(text)
 
 
 def _progress_warning(text):
+    text = _get_feed_prefix() + text
     print('\033[31m{}\033[0m'.format(text))
     logging.warning(text)
 
 
+def _get_feed_prefix():
+    feed_name = getattr(_FEED_THREAD, 'name', None)
+    return '' if feed_name is None else '{}: '.format(feed_name)
+
+
 def _load_config(config_path):
     with open(config_path) as config_file:
         return json.load(config_file)
 
 
-def _download_gtfs(url):
+def _load_download_state(filename, url):
+    """Load ETag, Last-Modified and hash of previous download of url, see _download_gtfs()."""
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as input_file:
+        download_state = json.load(input_file)
+    if download_state.get('url') != url:
+        return {}
+    return download_state
+
+
+def _save_download_state(filename, download_state):
+    if download_state:
+        _create_dir(os.path.dirname(filename) or '.')
+        _write_file_atomically(filename, json.dumps(download_state, indent=2).encode('utf-8'))
+
+
+def _download_gtfs(url, download_state):
+    """Download GTFS file if changed, return (filename or None, new download state)."""
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if download_state.get('etag'):
+        request.add_header('If-None-Match', download_state['etag'])
+    if download_state.get('last_modified'):
+        request.add_header('If-Modified-Since', download_state['last_modified'])
+    try:
+        response = urllib.request.urlopen(request, timeout=_DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            _progress('gtfs file not modified: {}'.format(url))
+            return None, download_state
+        raise SystemExit('failed to download {}: {}'.format(url, error))
+    except urllib.error.URLError as error:
+        raise SystemExit('failed to download {}: {}'.format(url, error.reason))
+
     output_file, output_filename = tempfile.mkstemp(dir='.')
-    os.close(output_file)
-    curl_options = '--header "Accept-Encoding: gzip" --location'
-    command = 'curl {} "{}" > {}'.format(curl_options, url, output_filename)
     _progress('downloading gtfs file into: {}'.format(os.path.relpath(output_filename)))
-    _execute_command(command)
-    return output_filename
+    try:
+        with response, os.fdopen(output_file, 'wb') as output:
+            file_hash, size = _write_response(response, output)
+    except (OSError, zlib.error, http.client.HTTPException) as error:
+        os.remove(output_filename)
+        raise SystemExit('failed to download {}: {}'.format(url, error))
+    new_download_state = {'url': url, 'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'hash': file_hash, 'size': size}
+    if file_hash == download_state.get('hash'):
+        _progress('downloaded gtfs file is identical to previous download')
+        os.remove(output_filename)
+        return None, new_download_state
+    return output_filename, new_download_state
+
+
+def _write_response(response, output_file):
+    """Write (gzip decoded) response into output file in chunks, return hash and size. Response
+    shorter than its Content-Length raises OSError."""
+    decompressor = None
+    if response.headers.get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    file_hash = hashlib.sha256()
+    size = 0
+    response_size = 0
+    for chunk in iter(lambda: response.read(_DOWNLOAD_CHUNK_SIZE), b''):
+        response_size += len(chunk)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        file_hash.update(chunk)
+        output_file.write(chunk)
+        size += len(chunk)
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        file_hash.update(chunk)
+        output_file.write(chunk)
+        size += len(chunk)
+    content_length = response.headers.get('Content-Length')
+    if (content_length is not None) and (response_size < int(content_length)):
+        raise OSError('incomplete response: {} of {} bytes'.format(response_size,
+                                                                   content_length))
+    return file_hash.hexdigest(), size
 
 
 def _execute_command(command):
-    if os.system(command) != 0:
-        raise SystemExit('failed to execute: {}'.format(command))
+    """Execute command (list of arguments) with its output as progress, return its rusage."""
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    with process.stdout:
+        for line in process.stdout:
+            _progress(line.rstrip('\n'))
+    _, status, rusage = os.wait4(process.pid, 0)  # rusage of this child only
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise SystemExit('failed to execute: {}'.format(' '.join(command)))
+    return rusage
 
 
 def _get_modify_date(zip_filename):
@@ -132,8 +411,7 @@ def _rename_gtfs_zip(gtfs_dir, old_filename, gtfs_name, modify_date):
 
 
 def _create_dir(new_dir):
-    if not os.path.isdir(new_dir):
-        os.makedirs(new_dir)
+    os.makedirs(new_dir, exist_ok=True)  # feeds may be converted in parallel
 
 
 def _compare_files(filename_a, filename_b):
@@ -143,11 +421,13 @@ def _compare_files(filename_a, filename_b):
 def _get_hash(filename):
     file_hash = hashlib.sha256()
     with open(filename, 'rb') as input_file:
-        file_hash.update(input_file.read())
+        for chunk in iter(lambda: input_file.read(_DOWNLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
     return file_hash.digest()
 
 
-def _generate_json(gtfs_name, modify_date, gtfs_zip, json_dir, log_dir):
+def _generate_json(gtfs_name, modify_date, gtfs_zip, json_dir, log_dir, shape_cache_dir,
+                   metrics_dir):
     _create_dir(json_dir)
     date_output_file = os.path.join(json_dir, '{}_{}.json'.format(gtfs_name, modify_date))
     _rename_existing_file(date_output_file)
@@ -155,11 +435,19 @@ def _generate_json(gtfs_name, modify_date, gtfs_zip, json_dir, log_dir):
     log_path = os.path.join(log_dir, 'gtfs2json_{}_{}_{}.log'.format(gtfs_name, modify_date,
                                                                      _get_now_timestamp()))
     _progress('generating json for {}'.format(gtfs_zip))
-    command = '{}/gtfs2json.py --log-file {} {} {}'.format(os.path.dirname(__file__), log_path,
-                                                           gtfs_zip, date_output_file)
-    _execute_command(command)
+    command = [os.path.join(os.path.dirname(__file__), 'gtfs2json.py'), '--log-file', log_path,
+               gtfs_zip, date_output_file]
+    if shape_cache_dir:
+        command += ['--shape-cache-dir', shape_cache_dir]
+    if metrics_dir:
+        _create_dir(metrics_dir)
+        command += ['--metrics-file', os.path.join(
+            metrics_dir, 'gtfs2json_{}_{}_{}.json'.format(gtfs_name, modify_date,
+                                                          _get_now_timestamp()))]
+    rusage = _execute_command(command)
 
     _create_base_output_file(date_output_file, os.path.join(json_dir, '{}.json'.format(gtfs_name)))
+    return date_output_file, rusage
 
 
 def _create_base_output_file(date_output_file, base_output_file):
@@ -170,6 +458,60 @@ def _create_base_output_file(date_output_file, base_output_file):
     shutil.copyfile(date_output_file, base_output_file)
 
 
+def _create_hashed_files(output_file, hashed_dir, gtfs_name):
+    """Copy output file into hashed_dir named by hash of its content together with gzip (and
+    brotli if available) compressed variants at maximum level, so that they can be cached
+    forever. Pointer file <gtfs_name>_current.json names the current files."""
+    _create_dir(hashed_dir)
+    with open(output_file, 'rb') as input_file:
+        content = input_file.read()
+    content_hash = hashlib.sha256(content).hexdigest()[:16]
+    suffix = os.path.splitext(output_file)[1]
+    hashed_file = '{}_{}{}'.format(gtfs_name, content_hash, suffix)
+    pointer = {'hash': content_hash, 'file': hashed_file, 'size': len(content), 'variants': {}}
+
+    variants = {'identity': (hashed_file, lambda data: data),
+                'gzip': (hashed_file + '.gz', _gzip_compress)}
+    if brotli is not None:
+        variants['br'] = (hashed_file + '.br', lambda data: brotli.compress(data, quality=11))
+    for encoding, (filename, compress) in variants.items():
+        compressed_content = compress(content)
+        _write_file_atomically(os.path.join(hashed_dir, filename), compressed_content)
+        pointer['variants'][encoding] = {'file': filename, 'size': len(compressed_content)}
+        _progress('created {} ({} bytes)'.format(filename, len(compressed_content)))
+
+    pointer_file = os.path.join(hashed_dir, '{}_current.json'.format(gtfs_name))
+    _write_file_atomically(pointer_file, json.dumps(pointer, indent=2).encode('utf-8'))
+    _delete_old_hashed_files(hashed_dir, gtfs_name, suffix)
+
+
+def _gzip_compress(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _write_file_atomically(filename, content):
+    temp_filename = '{}.tmp'.format(filename)
+    with open(temp_filename, 'wb') as output_file:
+        output_file.write(content)
+    os.replace(temp_filename, filename)
+
+
+def _delete_old_hashed_files(hashed_dir, gtfs_name, suffix):
+    """Delete hashed files except three newest ones (and their compressed variants), so that
+    clients with old pointer file still find their files for a while."""
+    hashed_file_pattern = re.escape(gtfs_name) + r'_[0-9a-f]{16}' + re.escape(suffix)
+    hashed_files = []
+    for filename in os.listdir(hashed_dir):
+        if re.fullmatch(hashed_file_pattern, filename):
+            hashed_files.append(filename)
+    hashed_files.sort(key=lambda filename: os.path.getmtime(os.path.join(hashed_dir, filename)))
+    for old_file in hashed_files[:-3]:
+        for filename in [old_file, old_file + '.gz', old_file + '.br']:
+            if os.path.isfile(os.path.join(hashed_dir, filename)):
+                _progress('deleting {}'.format(filename))
+                os.remove(os.path.join(hashed_dir, filename))
+
+
 def _rename_existing_file(filename):
     if os.path.isfile(filename):
         suffix = filename.split('.')[-1]
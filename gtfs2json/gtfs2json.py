@@ -9,50 +9,124 @@ Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
 """
 
 import argparse
-import collections
 import csv
+import datetime
 import logging
 import os
 import resource
 import sys
 import time
 
+import encoding_cache
 import gtfs2json_gtfs
 import gtfs2json_json
+import phase_metrics
 
 
 def _main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_dir_or_zip', help='GTFS input directory or ZIP file')
+    parser.add_argument('input_dir_or_zip', nargs='?', help='GTFS input directory or ZIP file')
     parser.add_argument('output_file', help='JSON output file')
     parser.add_argument('--log-file', default='gtfs2json.log', help='Log file')
     parser.add_argument('--additional-files', help='Additional JSON output files')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes for encoding shapes and writing files')
+    parser.add_argument('--shape-cache-dir', help='Directory for caching encoded shapes')
+    parser.add_argument('--shape-cache-size', type=int, default=500,
+                        help='Maximum size of shape cache in megabytes')
+    parser.add_argument('--snapshot', help='Save parsed GTFS into snapshot file')
+    parser.add_argument('--from-snapshot',
+                        help='Load parsed GTFS from snapshot file instead of GTFS input')
+    parser.add_argument('--shard-routes', type=int,
+                        help='Write output files as manifests and shard files of at most this '
+                             'many routes of one route type')
+    parser.add_argument('--binary', action='store_true',
+                        help='Write also binary (.bin) file of each JSON output file')
+    parser.add_argument('--trip-slice-minutes', type=int,
+                        help='Write trips into bucket files of this many minutes by start time')
+    parser.add_argument('--date-bitmaps', action='store_true',
+                        help='Write trip dates as bitmaps of active days')
+    parser.add_argument('--shared-strings', action='store_true',
+                        help='Write shapes, stop distances and stop times of routes into shared '
+                             'tables of each output file')
+    parser.add_argument('--date-window', type=_get_date_window,
+                        help='Include only trips active in START:DAYS (YYYYMMDD or today)')
+    parser.add_argument('--metrics-file', help='Save time and memory of each phase into JSON file')
     args = parser.parse_args()
+    if (args.input_dir_or_zip is None) == (args.from_snapshot is None):
+        parser.error('give either input_dir_or_zip or --from-snapshot')
+    if args.date_window and args.from_snapshot:
+        parser.error('--date-window can not be used with --from-snapshot')
+    if (args.trip_slice_minutes is not None) and (args.trip_slice_minutes < 1):
+        parser.error('--trip-slice-minutes must be positive')
+    if args.binary and args.shard_routes:
+        parser.error('--binary can not be used with --shard-routes')
+    if args.binary and args.trip_slice_minutes:
+        parser.error('--binary can not be used with --trip-slice-minutes')
 
     _init_logging(args.log_file)
 
     start_time = time.time()
     logging.debug('started {}'.format(sys.argv))
-
-    routes = gtfs2json_gtfs.get_routes(args.input_dir_or_zip)
-    gtfs_modification_time = gtfs2json_gtfs.get_modification_time(args.input_dir_or_zip)
-    print('creating output file...')
-    gtfs2json_json.create(routes, args.output_file, gtfs_modification_time)
-
+    metrics = phase_metrics.create('gtfs2json', argv=sys.argv, jobs=args.jobs)
+
+    if args.from_snapshot:
+        with phase_metrics.measure(metrics, 'load_snapshot') as phase:
+            print('loading snapshot...')
+            routes, gtfs_modification_time = gtfs2json_gtfs.load_snapshot(args.from_snapshot)
+            phase['count'] = len(routes)
+    else:
+        shape_cache = None
+        if args.shape_cache_dir:
+            shape_cache = encoding_cache.create(args.shape_cache_dir, args.shape_cache_size)
+        with gtfs2json_gtfs.open_feed(args.input_dir_or_zip) as feed:
+            routes = gtfs2json_gtfs.get_routes(feed, args.jobs, shape_cache, metrics,
+                                               args.date_window)
+            gtfs_modification_time = gtfs2json_gtfs.get_modification_time(feed)
+        if args.snapshot:
+            with phase_metrics.measure(metrics, 'save_snapshot') as phase:
+                print('saving snapshot...')
+                gtfs2json_gtfs.save_snapshot(routes, gtfs_modification_time, args.snapshot)
+                phase['count'] = len(routes)
+    metrics['info']['gtfs_modification_time'] = gtfs_modification_time
+    output_files = [{'filename': args.output_file, 'route_ids': list(routes)}]
     if args.additional_files:
-        additional_output_files = _get_additional_output_files(args.additional_files)
-        print('creating additional output files...')
         output_dir = os.path.dirname(args.output_file)
-        for additional_output_file in additional_output_files:
-            output_filename = os.path.join(output_dir, additional_output_file['filename'])
-            filtered_routes = _get_filtered_routes(routes, additional_output_file['agencies'])
-            logging.debug('creating {}'.format(output_filename))
-            gtfs2json_json.create(filtered_routes, output_filename, gtfs_modification_time)
-
+        for additional_output_file in _get_additional_output_files(args.additional_files):
+            output_files.append({
+                'filename': os.path.join(output_dir, additional_output_file['filename']),
+                'route_ids': _get_filtered_route_ids(routes, additional_output_file['agencies'])
+            })
+    for output_file in output_files:
+        output_file['shard_routes'] = args.shard_routes
+        if args.binary:
+            output_file['binary_filename'] = os.path.splitext(output_file['filename'])[0] + '.bin'
+    print('creating output files...')
+    gtfs2json_json.create_files(routes, output_files, gtfs_modification_time, args.jobs, metrics,
+                                args.trip_slice_minutes, args.date_bitmaps, args.shared_strings)
+
+    if args.metrics_file:
+        phase_metrics.save(metrics, args.metrics_file)
     logging.debug('took {} seconds, max mem: {} megabytes'.format(
         int(time.time() - start_time), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
 
 
+def _get_date_window(value):
+    """Get (first_date, last_date) as YYYYMMDD from START:DAYS."""
+    try:
+        (start, days) = value.split(':')
+        if start == 'today':
+            first_date = datetime.date.today()
+        else:
+            first_date = datetime.datetime.strptime(start, '%Y%m%d').date()
+        last_date = first_date + datetime.timedelta(days=int(days) - 1)
+        if int(days) < 1:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid START:DAYS: {}'.format(value))
+    return (first_date.strftime('%Y%m%d'), last_date.strftime('%Y%m%d'))
+
+
 def _init_logging(filename):
     log_format = '%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(funcName)s: %(message)s'
     logging.basicConfig(filename=filename, format=log_format, level=logging.DEBUG)
@@ -76,12 +150,12 @@ def _get_additional_output_files(filename):
     return additional_output_files
 
 
-def _get_filtered_routes(routes, agencies):
-    filtered_routes = collections.OrderedDict()
+def _get_filtered_route_ids(routes, agencies):
+    filtered_route_ids = []
     for route in routes.values():
         if route['agency_id'] in agencies:
-            filtered_routes[route['route_id']] = route
-    return filtered_routes
+            filtered_route_ids.append(route['route_id'])
+    return filtered_route_ids
 
 
 if __name__ == "__main__":
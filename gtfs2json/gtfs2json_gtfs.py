@@ -5,122 +5,242 @@ General Transit Feed Specification Reference: https://developers.google.com/tran
 Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
 """
 
+import array
 import codecs
 import collections
+import contextlib
 import csv
 import datetime
+import functools
 import io
 import json
 import logging
 import os
 import math
+import mmap
+import multiprocessing
+import operator
+import pickle
+import struct
 import time
 import zipfile
 
+import encoding_cache
+import interning
+import phase_metrics
 import polyline
 
-
-def get_routes(input_dir_or_zip):
-    """Parse GTFS files into dict of routes."""
-    print('parsing shapes...')
-    shapes = _parse_shapes(input_dir_or_zip, 'shapes.txt')
-    print('parsing stops...')
-    stops = _parse_stops(input_dir_or_zip, 'stops.txt')
-    print('parsing calendar...')
-    calendar_entries = _parse_calendar(input_dir_or_zip, 'calendar.txt')
-    print('parsing calendar dates...')
-    calendar_dates = _parse_calendar_dates(input_dir_or_zip, 'calendar_dates.txt')
-    print('parsing stop times...')
-    stop_times = _parse_stop_times(input_dir_or_zip, 'stop_times.txt')
-    print('parsing routes...')
-    routes = _parse_routes(input_dir_or_zip, 'routes.txt')
-    print('parsing trips...')
-    trips = _parse_trips(input_dir_or_zip, 'trips.txt')
-
-    print('adding dates to trips...')
-    _add_dates_to_trips(trips, calendar_entries, calendar_dates)
-    print('adding stop times to trips...')
-    _add_stop_times_to_trips(trips, stop_times)
-
-    print('adding trips to routes...')
-    _add_trips_to_routes(routes, trips)
-    print('adding shapes to routes...')
-    _add_shapes_to_routes(routes, shapes, stops)
-
-    _delete_invalid_trips(routes)
-    _delete_invalid_routes(routes)
+_VERY_SMALL = 0.00002  # tolerance of shape encoding, see polyline.encode()
+
+
+def get_routes(feed, jobs=1, shape_cache=None, metrics=None, date_window=None):
+    """Parse GTFS files of feed (see open_feed()) into dict of routes."""
+    with phase_metrics.measure(metrics, 'parse_shapes') as phase:
+        print('parsing shapes...')
+        shapes = _parse_shapes(feed, 'shapes.txt')
+        phase['count'] = len(shapes)
+    with phase_metrics.measure(metrics, 'parse_stops') as phase:
+        print('parsing stops...')
+        stops = _parse_stops(feed, 'stops.txt')
+        phase['count'] = len(stops)
+    with phase_metrics.measure(metrics, 'parse_calendar') as phase:
+        print('parsing calendar...')
+        calendar_entries = _parse_calendar(feed, 'calendar.txt')
+        phase['count'] = len(calendar_entries)
+    with phase_metrics.measure(metrics, 'parse_calendar_dates') as phase:
+        print('parsing calendar dates...')
+        calendar_dates = _parse_calendar_dates(feed, 'calendar_dates.txt')
+        phase['count'] = len(calendar_dates)
+    with phase_metrics.measure(metrics, 'parse_stop_times') as phase:
+        print('parsing stop times...')
+        stop_times = _parse_stop_times(feed, 'stop_times.txt')
+        phase['count'] = len(stop_times['stops'])
+    with phase_metrics.measure(metrics, 'parse_routes') as phase:
+        print('parsing routes...')
+        routes = _parse_routes(feed, 'routes.txt')
+        phase['count'] = len(routes)
+    with phase_metrics.measure(metrics, 'parse_trips') as phase:
+        print('parsing trips...')
+        trips = _parse_trips(feed, 'trips.txt')
+        phase['count'] = len(trips)
+
+    if date_window is not None:
+        with phase_metrics.measure(metrics, 'apply_date_window') as phase:
+            inactive_service_ids = _apply_date_window(calendar_entries, calendar_dates,
+                                                      date_window)
+            _delete_inactive_trips(trips, inactive_service_ids)
+            phase['count'] = len(trips)
+    with phase_metrics.measure(metrics, 'add_dates_to_trips') as phase:
+        print('adding dates to trips...')
+        _add_dates_to_trips(trips, calendar_entries, calendar_dates)
+        phase['count'] = len(trips)
+    with phase_metrics.measure(metrics, 'add_stop_times_to_trips') as phase:
+        print('adding stop times to trips...')
+        _add_stop_times_to_trips(trips, stop_times)
+        phase['count'] = len(trips)
+
+    with phase_metrics.measure(metrics, 'add_trips_to_routes') as phase:
+        print('adding trips to routes...')
+        _add_trips_to_routes(routes, trips)
+        phase['count'] = len(trips)
+    with phase_metrics.measure(metrics, 'add_shapes_to_routes') as phase:
+        print('adding shapes to routes...')
+        phase['count'] = _add_shapes_to_routes(routes, shapes, stops, jobs, shape_cache)
+
+    with phase_metrics.measure(metrics, 'delete_invalid') as phase:
+        _delete_invalid_trips(routes)
+        _delete_invalid_routes(routes)
+        phase['count'] = len(routes)
 
     return routes
 
 
-def _parse_shapes(input_dir_or_zip, shapes_txt):
+def _parse_shapes(feed, shapes_txt):
     shapes = {}  # by shape_id
 
-    with _open_file(input_dir_or_zip, shapes_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            if row['shape_id'] not in shapes:
-                shapes[row['shape_id']] = {'is_invalid': False, 'points': []}
-            point = (float(row['shape_pt_lat']), float(row['shape_pt_lon']))
-            shapes[row['shape_id']]['points'].append(point)
+    with _open_file(feed, shapes_txt) as input_file:
+        for shape_id, lat, lon in _read_rows(input_file, ['shape_id', 'shape_pt_lat',
+                                                          'shape_pt_lon']):
+            if shape_id not in shapes:
+                shapes[shape_id] = {'is_invalid': False, 'points': [], 'point_index': None}
+            point = (float(lat), float(lon))
+            shapes[shape_id]['points'].append(point)
             if (point == (58.432233, 20.142573)) or (point[0] < 0) or (point[1] < 0):
-                shapes[row['shape_id']]['is_invalid'] = True
+                shapes[shape_id]['is_invalid'] = True
 
     logging.debug('parsed {} shapes'.format(len(shapes)))
 
     return shapes
 
 
-def _open_file(input_dir_or_zip, path, skip_utf8_bom=False):
+@contextlib.contextmanager
+def open_feed(input_dir_or_zip):
+    """Open GTFS input directory or ZIP file for get_routes() and get_modification_time(). ZIP
+    file is opened and its member list is read only once."""
+    feed = {'path': input_dir_or_zip, 'zip_file': None, 'zip_data': None, 'members': None}
     if os.path.isdir(input_dir_or_zip):
-        return open(os.path.join(input_dir_or_zip, path), 'r', encoding='utf-8-sig')
+        yield feed
+    else:
+        with open(input_dir_or_zip, 'rb') as input_file:
+            with zipfile.ZipFile(input_file) as zip_file:
+                with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as zip_data:
+                    feed['zip_file'] = zip_file
+                    feed['zip_data'] = zip_data
+                    feed['members'] = {info.filename: info for info in zip_file.infolist()}
+                    yield feed
+
+
+_READ_BUFFER_SIZE = 1024 * 1024
+
+
+@contextlib.contextmanager
+def _open_file(feed, path):
+    """Open file of feed for reading lines (with line endings and without UTF-8 BOM). Files in
+    directory and uncompressed files in ZIP file are memory mapped, compressed files are
+    decompressed using large buffer."""
+    if feed['zip_file'] is None:
+        with open(os.path.join(feed['path'], path), 'rb') as input_file:
+            if os.fstat(input_file.fileno()).st_size == 0:
+                yield iter([])
+            else:
+                with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    yield _get_mmap_lines(data, 0, len(data))
     else:
-        with zipfile.ZipFile(input_dir_or_zip) as zip_file:
-            input_file = zip_file.open(path)
-            if skip_utf8_bom:
-                if input_file.read(3) != codecs.BOM_UTF8:
-                    input_file = zip_file.open(path)
-            return io.TextIOWrapper(input_file)
+        info = feed['members'][path]
+        if (info.compress_type == zipfile.ZIP_STORED) and (info.file_size > 0):
+            start = _get_zip_member_data_offset(feed['zip_data'], info)
+            yield _get_mmap_lines(feed['zip_data'], start, start + info.file_size)
+        else:
+            with feed['zip_file'].open(info) as member_file:
+                yield io.TextIOWrapper(io.BufferedReader(member_file, _READ_BUFFER_SIZE),
+                                       encoding='utf-8-sig', newline='')
 
 
-def _is_file(input_dir_or_zip, path):
-    if os.path.isdir(input_dir_or_zip):
-        return os.path.isfile(os.path.join(input_dir_or_zip, path))
+def _get_zip_member_data_offset(zip_data, info):
+    # local file header is 30 bytes with file name length at 26 and extra field length at 28
+    (name_length, extra_length) = struct.unpack(
+        '<HH', zip_data[info.header_offset + 26:info.header_offset + 30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def _get_mmap_lines(data, start, end):
+    if data[start:start + len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+        start += len(codecs.BOM_UTF8)
+    data.seek(start)
+    while data.tell() < end:
+        line = data.readline()
+        if data.tell() > end:
+            line = line[:len(line) - (data.tell() - end)]
+        yield line.decode('utf-8')
+
+
+def _is_file(feed, path):
+    if feed['zip_file'] is None:
+        return os.path.isfile(os.path.join(feed['path'], path))
     else:
-        with zipfile.ZipFile(input_dir_or_zip) as zip_file:
-            return path in zip_file.namelist()
+        return path in feed['members']
+
+
+def _read_rows(input_file, column_names, defaults=None):
+    """Read CSV lines of input file (see _open_file()) and yield tuple of column_names values."""
+    csv_reader = csv.reader(input_file)
+    header = next(csv_reader, [])
+    if not header:
+        return
+    defaults = defaults or {}
+    missing_values = []
+    indexes = []
+    for column_name in column_names:
+        if column_name in header:
+            indexes.append(header.index(column_name))
+        elif column_name in defaults:
+            indexes.append(len(header) + len(missing_values))
+            missing_values.append(defaults[column_name])
+        else:
+            raise SystemExit('column {} missing from header: {}'.format(column_name, header))
+    get_values = operator.itemgetter(*indexes)
+    num_columns = len(header)
+    for row in csv_reader:
+        if len(row) < num_columns:
+            if not row:
+                continue
+            row += [''] * (num_columns - len(row))
+        if missing_values:
+            row = row[:num_columns] + missing_values
+        yield get_values(row)
 
 
-def _parse_stops(input_dir_or_zip, stops_txt):
+def _parse_stops(feed, stops_txt):
     stops = {}
 
-    with _open_file(input_dir_or_zip, stops_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            stops[row['stop_id']] = (float(row['stop_lat']), float(row['stop_lon']))
+    with _open_file(feed, stops_txt) as input_file:
+        for stop_id, lat, lon in _read_rows(input_file, ['stop_id', 'stop_lat', 'stop_lon']):
+            stops[stop_id] = (float(lat), float(lon))
 
     logging.debug('parsed {} stops'.format(len(stops)))
 
     return stops
 
 
-def _parse_routes(input_dir_or_zip, routes_txt):
+def _parse_routes(feed, routes_txt):
     routes = collections.OrderedDict()  # by route_id
     route_types = _get_route_types(os.path.join(os.path.dirname(__file__), 'route_types.json'))
 
-    with _open_file(input_dir_or_zip, routes_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            if row['route_type'] not in route_types:
+    with _open_file(feed, routes_txt) as input_file:
+        column_names = ['route_id', 'agency_id', 'route_short_name', 'route_long_name',
+                        'route_type']
+        for route_id, agency_id, short_name, long_name, route_type in _read_rows(
+                input_file, column_names, {'agency_id': 0}):
+            if route_type not in route_types:
                 logging.error('In route_id={} route_type {} not in {}'.format(
-                    row['route_id'], row['route_type'], route_types))
+                    route_id, route_type, route_types))
             # create new route
-            routes[row['route_id']] = {
-                'agency_id': row.get('agency_id', 0),
-                'route_id': row['route_id'],
-                'name': _get_route_name(row),
-                'long_name': row['route_long_name'],
-                'type': route_types.get(row['route_type'], row['route_type']),
+            routes[route_id] = {
+                'agency_id': agency_id,
+                'route_id': route_id,
+                'name': _get_route_name(route_id, short_name),
+                'long_name': long_name,
+                'type': route_types.get(route_type, route_type),
                 'is_departure_times': False,
                 'trips': collections.OrderedDict(),
                 'shapes': []
@@ -144,53 +264,45 @@ def _get_route_types(route_types_path):
     return route_types
 
 
-def _get_route_name(row):  # row in routes.txt
-    if row['route_short_name'] != '':
-        return row['route_short_name']
+def _get_route_name(route_id, route_short_name):
+    if route_short_name != '':
+        return route_short_name
     else:
-        return row['route_id']  # HSL metro routes do not have short names
+        return route_id  # HSL metro routes do not have short names
 
 
-def _parse_trips(input_dir_or_zip, trips_txt):
+def _parse_trips(feed, trips_txt):
     trips = collections.OrderedDict()  # by trip_id
 
-    with _open_file(input_dir_or_zip, trips_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            if ('direction_id' in row) and (row['direction_id'] not in ['0', '1']):
+    with _open_file(feed, trips_txt) as input_file:
+        column_names = ['trip_id', 'route_id', 'service_id', 'direction_id', 'shape_id']
+        for trip_id, route_id, service_id, direction_id, shape_id in _read_rows(
+                input_file, column_names, {'direction_id': None}):
+            if (direction_id is not None) and (direction_id not in ['0', '1']):
                 logging.error('For trip_id={} invalid direction_id: {}.'.format(
-                    row['trip_id'], row['direction_id']))
+                    trip_id, direction_id))
             else:
-                if row['trip_id'] in trips:
-                    logging.error('Duplicate trip_id={} in {}'.format(row['trip_id'], trips_txt))
+                if trip_id in trips:
+                    logging.error('Duplicate trip_id={} in {}'.format(trip_id, trips_txt))
                 else:
-                    # create new trip
-                    trips[row['trip_id']] = {
-                        'route_id': row['route_id'],
-                        'service_id': row['service_id'],
-                        'direction_id': row.get('direction_id', '-'),
-                        'shape_id': row['shape_id'],
-                        'stops': {},  # by stop_sequence
+                    # create new trip, one flat dict per trip (there may be lots of trips)
+                    trips[trip_id] = {
+                        'route_id': route_id,
+                        'service_id': service_id,
+                        'direction_id': '-' if direction_id is None else direction_id,
+                        'shape_id': shape_id,
+                        'stops': (),  # stop_ids in stop_sequence order
                         'stop_distances': [],  # point indexes in encoded shape
-                        'dates': {
-                            'start_date': None,
-                            'end_date': None,
-                            'weekdays': None,
-                            'exception_dates': collections.OrderedDict([('added', []),
-                                                                        ('removed', [])])
-                        },
-                        'times': {
-                            'start_time': 0,  # number of minutes after midnight
-                            'is_departure_times': False,
-                            'stop_times': []  # arrival and departure times for each stop
-                        },
-                        'cache_indexes': {
-                            'shape_i': None,
-                            'stop_distances_i': None,
-                            'stop_times_i': None,
-                            'trip_dates_i': None,
-                            'trip_group_i': None
-                        },
+                        'dates': None,  # shared by trips of service, see _get_service_dates()
+                        'start_time': 0,  # number of minutes after midnight
+                        'is_departure_times': False,
+                        'stop_times': [],  # arrival and departure times for each stop
+                        # cache indexes
+                        'shape_i': None,
+                        'stop_distances_i': None,
+                        'stop_times_i': None,
+                        'trip_dates_i': None,
+                        'trip_group_i': None,
                         'is_invalid': False
                     }
 
@@ -199,19 +311,21 @@ def _parse_trips(input_dir_or_zip, trips_txt):
     return trips
 
 
-def _parse_calendar(input_dir_or_zip, calendar_txt):
+def _parse_calendar(feed, calendar_txt):
     calendar_entries = {}
-    if _is_file(input_dir_or_zip, calendar_txt):
-        with _open_file(input_dir_or_zip, calendar_txt, skip_utf8_bom=True) as input_file:
-            csv_reader = csv.DictReader(input_file)
-            for row in csv_reader:
-                if row['service_id'] in calendar_entries:
-                    logging.error('duplicate service_id={} in calendar'.format(row['service_id']))
+    if _is_file(feed, calendar_txt):
+        with _open_file(feed, calendar_txt) as input_file:
+            column_names = ['service_id', 'start_date', 'end_date', 'monday', 'tuesday',
+                            'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+            for row in _read_rows(input_file, column_names):
+                service_id = row[0]
+                if service_id in calendar_entries:
+                    logging.error('duplicate service_id={} in calendar'.format(service_id))
                 else:
-                    calendar_entries[row['service_id']] = {
-                        'start_date': row['start_date'],
-                        'end_date': row['end_date'],
-                        'weekdays': _get_service_weekdays(row)
+                    calendar_entries[service_id] = {
+                        'start_date': row[1],
+                        'end_date': row[2],
+                        'weekdays': _get_service_weekdays(list(row[3:]))
                     }
 
         logging.debug('parsed {} calendar entries'.format(len(calendar_entries)))
@@ -219,75 +333,206 @@ def _parse_calendar(input_dir_or_zip, calendar_txt):
     return calendar_entries
 
 
-def _get_service_weekdays(row):  # row in calendar.txt
-    days = [row['monday'], row['tuesday'], row['wednesday'], row['thursday'], row['friday'],
-            row['saturday'], row['sunday']]
+def _get_service_weekdays(days):  # monday - sunday in calendar.txt
     if ''.join(sorted(days)) == '0000001':  # exactly one weekday (HSL)
         return days.index('1')
     else:
         return ''.join(days)
 
 
-def _parse_calendar_dates(input_dir_or_zip, calendar_dates_txt):
+def _parse_calendar_dates(feed, calendar_dates_txt):
     calendar_dates = collections.OrderedDict()
     exception_types = {'1': 'added', '2': 'removed'}
-    with _open_file(input_dir_or_zip, calendar_dates_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            if row['exception_type'] in exception_types:
-                if not row['service_id'] in calendar_dates:
-                    calendar_dates[row['service_id']] = {
+    with _open_file(feed, calendar_dates_txt) as input_file:
+        for service_id, date, exception_type in _read_rows(
+                input_file, ['service_id', 'date', 'exception_type']):
+            if exception_type in exception_types:
+                if not service_id in calendar_dates:
+                    calendar_dates[service_id] = {
                         'added': [],
                         'removed': []
                     }
-                exception_type = exception_types[row['exception_type']]
-                calendar_dates[row['service_id']][exception_type].append(row['date'])
+                calendar_dates[service_id][exception_types[exception_type]].append(date)
             else:
                 logging.error('For service_id={} invalid exception_type: {}.'.format(
-                    row['service_id'], row['exception_type']))
+                    service_id, exception_type))
     return calendar_dates
 
 
-def _parse_stop_times(input_dir_or_zip, stop_times_txt):
-    stop_time_trips = collections.OrderedDict()  # by trip_id
-    is_seconds_in_time = False
+def _apply_date_window(calendar_entries, calendar_dates, date_window):
+    """Restrict calendar entries and calendar dates to dates in date_window: start and end dates
+    are clamped into the window and exception dates outside of it are dropped. Services
+    without active dates in the window are deleted and their service_ids are returned."""
+    (first_date, last_date) = date_window
+    inactive_service_ids = set()
+    for service_id in set(calendar_entries) | set(calendar_dates):
+        exception_dates = calendar_dates.get(service_id, {'added': [], 'removed': []})
+        added = [date for date in exception_dates['added'] if first_date <= date <= last_date]
+        removed = [date for date in exception_dates['removed'] if first_date <= date <= last_date]
+        is_calendar_active = False
+        if service_id in calendar_entries:
+            calendar_entry = calendar_entries[service_id]
+            calendar_entry['start_date'] = max(calendar_entry['start_date'], first_date)
+            calendar_entry['end_date'] = min(calendar_entry['end_date'], last_date)
+            is_calendar_active = _is_calendar_entry_active(calendar_entry, removed)
+            if not is_calendar_active:
+                del calendar_entries[service_id]
+        if service_id in calendar_dates:
+            if added or (removed and is_calendar_active):
+                calendar_dates[service_id] = {'added': added,
+                                              'removed': removed if is_calendar_active else []}
+            else:
+                del calendar_dates[service_id]
+        if (not is_calendar_active) and (not added):
+            inactive_service_ids.add(service_id)
+
+    logging.debug('date window {}-{}: {} inactive services'.format(
+        first_date, last_date, len(inactive_service_ids)))
+    return inactive_service_ids
 
-    with _open_file(input_dir_or_zip, stop_times_txt, skip_utf8_bom=True) as input_file:
-        csv_reader = csv.DictReader(input_file)
-        for row in csv_reader:
-            if ':' not in row['arrival_time']:
-                logging.info('Invalid arrival_time in {}.'.format(row))
+
+def _is_calendar_entry_active(calendar_entry, removed_dates):
+    """Check if any date between start and end date of calendar entry is on its weekdays and is
+    not in removed_dates."""
+    if calendar_entry['start_date'] > calendar_entry['end_date']:
+        return False
+    date = datetime.datetime.strptime(calendar_entry['start_date'], '%Y%m%d').date()
+    end_date = datetime.datetime.strptime(calendar_entry['end_date'], '%Y%m%d').date()
+    weekdays = calendar_entry['weekdays']
+    while date <= end_date:
+        if isinstance(weekdays, int):
+            is_weekday = date.weekday() == weekdays
+        else:
+            is_weekday = weekdays[date.weekday()] == '1'
+        if is_weekday and (date.strftime('%Y%m%d') not in removed_dates):
+            return True
+        date += datetime.timedelta(days=1)
+    return False
+
+
+def _delete_inactive_trips(trips, inactive_service_ids):
+    inactive_trip_ids = [trip_id for trip_id, trip in trips.items()
+                         if trip['service_id'] in inactive_service_ids]
+    for trip_id in inactive_trip_ids:
+        del trips[trip_id]
+    logging.debug('deleted {} trips without dates in date window'.format(len(inactive_trip_ids)))
+
+
+def _parse_stop_times(feed, stop_times_txt):
+    stop_time_rows = _read_stop_time_rows(feed, stop_times_txt)
+    stop_times = _get_stop_time_trips(stop_time_rows)
+    _delete_invalid_stop_trip_times(stop_times)
+    return stop_times
+
+
+def _read_stop_time_rows(feed, stop_times_txt):
+    """Read stop_times.txt into typed arrays, one item per row."""
+    stop_time_rows = {
+        'trip_ids': [],  # interned, in order of first appearance
+        'stop_ids': [],  # interned, in order of first appearance
+        'trip_is': array.array('i'),  # index in trip_ids
+        'stop_is': array.array('i'),  # index in stop_ids
+        'stop_sequences': array.array('i'),
+        'arrival_times': array.array('i'),  # number of minutes after midnight
+        'departure_times': array.array('i'),
+        'is_grouped_by_trip': True
+    }
+    trip_ids = interning.create(stop_time_rows['trip_ids'])
+    stop_ids = interning.create(stop_time_rows['stop_ids'])
+    is_seconds_in_time = False
+    get_minutes = functools.lru_cache(maxsize=None)(_get_minutes)  # times repeat a lot
+
+    with _open_file(feed, stop_times_txt) as input_file:
+        column_names = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+        for trip_id, arrival_time, departure_time, stop_id, stop_sequence in _read_rows(
+                input_file, column_names):
+            if ':' not in arrival_time:
+                logging.info('Invalid arrival_time in trip_id={}: {}.'.format(trip_id,
+                                                                              arrival_time))
                 continue
             if not is_seconds_in_time:
-                is_seconds_in_time = _is_seconds_in_time(row)
-            if row['trip_id'] not in stop_time_trips:
-                stop_time_trips[row['trip_id']] = {
-                    'is_departure_times': False,
-                    'start_time': None,
-                    'stop_times': [],
-                    'stops': {}
-                }
-            trip = stop_time_trips[row['trip_id']]
-            if len(trip['stop_times']) == 0:
-                trip['start_time'] = _get_minutes(row['arrival_time'])
-            arrival_time = _get_minutes(row['arrival_time'])
-            departure_time = _get_minutes(row['departure_time'])
-            if _is_duplicate_stop_id(trip, row, arrival_time, departure_time):
-                logging.info('Ignoring duplicate stop_id={} in trip_id={}.'.format(row['stop_id'],
-                                                                                   row['trip_id']))
-            else:
-                trip['is_departure_times'] = (trip['is_departure_times'] or
-                                              (arrival_time != departure_time))
-                trip['stop_times'].append(arrival_time - trip['start_time'])
-                trip['stop_times'].append(departure_time - trip['start_time'])
-                _add_stop_to_stops(trip['stops'], row)
-    _delete_invalid_stop_trip_times(stop_time_trips)
-    return stop_time_trips
-
-
-def _is_seconds_in_time(row):  # row in stop_times.txt
-    for time_type in ['arrival_time', 'departure_time']:
-        if not row[time_type].endswith(':00'):
+                is_seconds_in_time = _is_seconds_in_time(arrival_time, departure_time)
+            trip_i = interning.get_index(trip_ids, trip_id)
+            is_new_trip = trip_i == (len(trip_ids['values']) - 1)
+            if (not is_new_trip) and (trip_i != stop_time_rows['trip_is'][-1]):
+                stop_time_rows['is_grouped_by_trip'] = False
+            stop_time_rows['trip_is'].append(trip_i)
+            stop_time_rows['stop_is'].append(interning.get_index(stop_ids, stop_id))
+            stop_time_rows['stop_sequences'].append(int(stop_sequence))
+            stop_time_rows['arrival_times'].append(get_minutes(arrival_time))
+            stop_time_rows['departure_times'].append(get_minutes(departure_time))
+
+    logging.debug('read {} stop time rows'.format(len(stop_time_rows['trip_is'])))
+
+    return stop_time_rows
+
+
+def _get_stop_time_trips(stop_time_rows):
+    """Compact rows of stop_times.txt into per-trip slices of flat typed arrays."""
+    stop_times = {
+        'trip_indexes': collections.OrderedDict(),  # by trip_id
+        'stop_ids': stop_time_rows['stop_ids'],
+        'start_times': array.array('i'),  # number of minutes after midnight
+        'is_departure_times': array.array('b'),
+        'time_offsets': array.array('L', [0]),  # trip slices in times
+        'times': array.array('i'),  # arrival and departure times relative to start time
+        'stop_offsets': array.array('L', [0]),  # trip slices in stops
+        'stops': array.array('i')  # indexes in stop_ids in stop_sequence order
+    }
+
+    if stop_time_rows['is_grouped_by_trip']:
+        row_indexes = range(len(stop_time_rows['trip_is']))
+    else:
+        row_indexes = sorted(range(len(stop_time_rows['trip_is'])),
+                             key=stop_time_rows['trip_is'].__getitem__)  # stable sort
+
+    trip_row_indexes = []
+    for row_i in row_indexes:
+        if trip_row_indexes and (stop_time_rows['trip_is'][row_i] !=
+                                 stop_time_rows['trip_is'][trip_row_indexes[0]]):
+            _add_stop_time_trip(stop_times, stop_time_rows, trip_row_indexes)
+            trip_row_indexes = []
+        trip_row_indexes.append(row_i)
+    if trip_row_indexes:
+        _add_stop_time_trip(stop_times, stop_time_rows, trip_row_indexes)
+
+    return stop_times
+
+
+def _add_stop_time_trip(stop_times, stop_time_rows, trip_row_indexes):
+    trip_id = stop_time_rows['trip_ids'][stop_time_rows['trip_is'][trip_row_indexes[0]]]
+    start_time = stop_time_rows['arrival_times'][trip_row_indexes[0]]
+    is_departure_times = False
+    trip_stops = {}  # stop indexes by stop_sequence
+    times = stop_times['times']
+
+    for row_i in trip_row_indexes:
+        arrival_time = stop_time_rows['arrival_times'][row_i]
+        departure_time = stop_time_rows['departure_times'][row_i]
+        stop_sequence = stop_time_rows['stop_sequences'][row_i]
+        stop_i = stop_time_rows['stop_is'][row_i]
+        if _is_duplicate_stop_id(trip_stops, times[-1] if trip_stops else None, stop_sequence,
+                                 stop_i, arrival_time - start_time, departure_time - start_time):
+            logging.info('Ignoring duplicate stop_id={} in trip_id={}.'.format(
+                stop_times['stop_ids'][stop_i], trip_id))
+        else:
+            is_departure_times = is_departure_times or (arrival_time != departure_time)
+            times.append(arrival_time - start_time)
+            times.append(departure_time - start_time)
+            _add_stop_to_stops(trip_stops, trip_id, stop_sequence, stop_i, stop_times['stop_ids'])
+
+    stop_times['trip_indexes'][trip_id] = len(stop_times['start_times'])
+    stop_times['start_times'].append(start_time)
+    stop_times['is_departure_times'].append(is_departure_times)
+    stop_times['time_offsets'].append(len(times))
+    stop_times['stops'].extend(trip_stops[stop_sequence] for stop_sequence in sorted(trip_stops))
+    stop_times['stop_offsets'].append(len(stop_times['stops']))
+
+
+def _is_seconds_in_time(arrival_time, departure_time):  # in stop_times.txt
+    for time_type, time_string in [('arrival_time', arrival_time),
+                                   ('departure_time', departure_time)]:
+        if not time_string.endswith(':00'):
             logging.info('Seconds in {}.'.format(time_type))
             return True
     return False
@@ -306,91 +551,113 @@ def _round(number):
         return int(math.ceil((number - 0.5)))
 
 
-def _is_duplicate_stop_id(trip, row, arrival_time, departure_time):  # row in stop_times.txt
-    if (trip['stop_times'] and trip['stops']) and (arrival_time == departure_time):
-        previous_stop_time = trip['stop_times'][-1]
-        next_stop_time = arrival_time - trip['start_time']
-        previous_stop_id = trip['stops'].get(int(row['stop_sequence']) - 1)
-        if (next_stop_time == previous_stop_time) and (row['stop_id'] == previous_stop_id):
+def _is_duplicate_stop_id(trip_stops, previous_stop_time, stop_sequence, stop_i, arrival_time,
+                          departure_time):
+    if (previous_stop_time is not None) and (arrival_time == departure_time):
+        previous_stop_i = trip_stops.get(stop_sequence - 1)
+        if (arrival_time == previous_stop_time) and (stop_i == previous_stop_i):
             return True
     return False
 
 
-def _add_stop_to_stops(stops, row):  # row in stop_times.txt
-    stop_sequence = int(row['stop_sequence'])
-    if stop_sequence not in stops:
-        stops[stop_sequence] = row['stop_id']
+def _add_stop_to_stops(trip_stops, trip_id, stop_sequence, stop_i, stop_ids):
+    if stop_sequence not in trip_stops:
+        trip_stops[stop_sequence] = stop_i
     else:
-        if stops[stop_sequence] != row['stop_id']:
+        if trip_stops[stop_sequence] != stop_i:
             logging.error('In trip_id={} two stops for stop_sequence={}: {} {}.'.format(
-                row['trip_id'], stop_sequence, row['stop_id'],
-                stops[stop_sequence]))
-
-
-def _delete_invalid_stop_trip_times(stop_time_trips):
-    invalid_trip_ids = []
-    for trip_id in stop_time_trips:
-        if _is_stop_times_invalid(trip_id, stop_time_trips[trip_id]['stop_times']):
-            invalid_trip_ids.append(trip_id)
-    for trip_id in invalid_trip_ids:
-        del stop_time_trips[trip_id]
-
-
-def _is_stop_times_invalid(trip_id, stop_times):
-    if len(stop_times) < 4:
-        reason = 'short'
-        is_invalid = True
-    elif stop_times != sorted(stop_times):
-        reason = 'order'
-        is_invalid = True
-    elif _get_max_stop_time_gap(stop_times) > (8 * 60):  # 8 hours
-        reason = 'gap'
-        is_invalid = True
-    else:
-        is_invalid = False
+                trip_id, stop_sequence, stop_ids[stop_i], stop_ids[trip_stops[stop_sequence]]))
+
+
+def _get_trip_stop_times(stop_times, trip_i):
+    """Get arrival and departure times of trip as a typed array slice."""
+    return stop_times['times'][stop_times['time_offsets'][trip_i]:
+                               stop_times['time_offsets'][trip_i + 1]]
 
-    if is_invalid:
+
+def _get_trip_stops(stop_times, trip_i):
+    """Get tuple of stop_ids of trip in stop_sequence order."""
+    trip_stops = stop_times['stops'][stop_times['stop_offsets'][trip_i]:
+                                     stop_times['stop_offsets'][trip_i + 1]]
+    return tuple(stop_times['stop_ids'][stop_i] for stop_i in trip_stops)
+
+
+def _delete_invalid_stop_trip_times(stop_times):
+    invalid_trips = _get_invalid_stop_trip_times(stop_times)
+    for trip_id, reason in invalid_trips.items():
+        trip_stop_times = _get_trip_stop_times(stop_times, stop_times['trip_indexes'][trip_id])
         msg_format = 'In trip_id={} invalid stop_times ({}): {}.'
-        logging.error(msg_format.format(trip_id, reason, stop_times))
+        logging.error(msg_format.format(trip_id, reason, trip_stop_times.tolist()))
+        del stop_times['trip_indexes'][trip_id]
 
-    return is_invalid
 
+_MAX_STOP_TIME_GAP = 8 * 60  # 8 hours
 
-def _get_max_stop_time_gap(stop_times):
-    max_gap = 0
-    for i in range(1, len(stop_times)):
-        max_gap = max(max_gap, stop_times[i] - stop_times[i - 1])
-    return max_gap
+
+def _get_invalid_stop_trip_times(stop_times):
+    """Get reason ('short' if under 4 stop times, 'order' or 'gap') by trip_id of invalid trips."""
+    times = stop_times['times']
+    time_offsets = stop_times['time_offsets']
+    # difference of each time and its previous time, differences between trips are never used
+    time_deltas = array.array('i', map(operator.sub, times[1:], times))
+    invalid_trips = collections.OrderedDict()
+    for trip_id, trip_i in stop_times['trip_indexes'].items():
+        (start, end) = (time_offsets[trip_i], time_offsets[trip_i + 1])
+        if (end - start) < 4:
+            invalid_trips[trip_id] = 'short'
+        else:
+            trip_time_deltas = time_deltas[start:end - 1]
+            if min(trip_time_deltas) < 0:
+                invalid_trips[trip_id] = 'order'
+            elif max(trip_time_deltas) > _MAX_STOP_TIME_GAP:
+                invalid_trips[trip_id] = 'gap'
+    return invalid_trips
 
 
 def _add_dates_to_trips(trips, calendar_entries, calendar_dates):
+    service_dates = {}  # by service_id
     for trip_id in trips:
         service_id = trips[trip_id]['service_id']
         if (service_id not in calendar_entries) and (service_id not in calendar_dates):
             trips[trip_id]['is_invalid'] = True
             logging.error('No dates for trip_id={}/service_id={}.'.format(trip_id, service_id))
         else:
-            dates = trips[trip_id]['dates']
-            if service_id in calendar_entries:
-                dates['start_date'] = calendar_entries[service_id]['start_date']
-                dates['end_date'] = calendar_entries[service_id]['end_date']
-                dates['weekdays'] = calendar_entries[service_id]['weekdays']
-            if service_id in calendar_dates:
-                dates['exception_dates']['added'] = calendar_dates[service_id]['added']
-                dates['exception_dates']['removed'] = calendar_dates[service_id]['removed']
+            if service_id not in service_dates:
+                service_dates[service_id] = _get_service_dates(
+                    calendar_entries.get(service_id), calendar_dates.get(service_id))
+            trips[trip_id]['dates'] = service_dates[service_id]
+
+
+def _get_service_dates(calendar_entry, calendar_date):
+    """Get dates of service, the same dict is shared by all trips of the service."""
+    dates = {
+        'start_date': None,
+        'end_date': None,
+        'weekdays': None,
+        'exception_dates': {'added': [], 'removed': []}
+    }
+    if calendar_entry is not None:
+        dates['start_date'] = calendar_entry['start_date']
+        dates['end_date'] = calendar_entry['end_date']
+        dates['weekdays'] = calendar_entry['weekdays']
+    if calendar_date is not None:
+        dates['exception_dates']['added'] = calendar_date['added']
+        dates['exception_dates']['removed'] = calendar_date['removed']
+    return dates
 
 
 def _add_stop_times_to_trips(trips, stop_times):
     for trip_id in trips:
-        if trip_id not in stop_times:
+        if trip_id not in stop_times['trip_indexes']:
             trips[trip_id]['is_invalid'] = True
             logging.error('No stop times for trip_id={}.'.format(trip_id))
         else:
-            trips[trip_id]['stops'] = stop_times[trip_id]['stops']
-            times = trips[trip_id]['times']
-            times['start_time'] = stop_times[trip_id]['start_time']
-            times['is_departure_times'] = stop_times[trip_id]['is_departure_times']
-            times['stop_times'] = stop_times[trip_id]['stop_times']
+            trip_i = stop_times['trip_indexes'][trip_id]
+            trip = trips[trip_id]
+            trip['stops'] = _get_trip_stops(stop_times, trip_i)
+            trip['start_time'] = stop_times['start_times'][trip_i]
+            trip['is_departure_times'] = bool(stop_times['is_departure_times'][trip_i])
+            trip['stop_times'] = _get_trip_stop_times(stop_times, trip_i)
 
 
 def _add_trips_to_routes(routes, trips):
@@ -402,36 +669,155 @@ def _add_trips_to_routes(routes, trips):
             trip = trips[trip_id]
             if trip['is_invalid'] is False:
                 routes[route_id]['trips'][trip_id] = trip
-                if trip['times']['is_departure_times']:
+                if trip['is_departure_times']:
                     routes[route_id]['is_departure_times'] = True
 
 
-def _add_shapes_to_routes(routes, shapes, stops):
-    stats = {'shapes': 0, 'points': 0, 'dropped_points': 0, 'bytes': 0}
+def _add_shapes_to_routes(routes, shapes, stops, jobs, shape_cache):
+    stats = _get_empty_shape_stats()
 
-    for route in routes.values():
-        cache = {}
-        for trip_id in route['trips']:
-            trip = route['trips'][trip_id]
-            if _is_shape_ok(route, trip, shapes):
-                cache_key = tuple(sorted(trip['stops'].items()))
-                if cache_key in cache:
-                    trip['stop_distances'] = cache[cache_key]['stop_distances']
-                    trip['cache_indexes']['shape_i'] = cache[cache_key]['shape_i']
-                else:
-                    shape = shapes[trip['shape_id']]['points']
-                    stop_distances = _get_stop_distances(shape, trip['stops'], stops)
-                    if _is_shape_long_enough(route, trip_id, shape, stop_distances, stops):
-                        _add_shape_to_route(route, trip, shape, stop_distances, stats)
-                        cache[cache_key] = {
-                            'shape_i': trip['cache_indexes']['shape_i'],
-                            'stop_distances': trip['stop_distances']}
-                    else:
-                        trip['is_invalid'] = True
-            else:
-                trip['is_invalid'] = True
+    if jobs > 1:
+        _add_shapes_to_routes_in_parallel(routes, shapes, stops, jobs, shape_cache, stats)
+    else:
+        shape_memo = {}
+        for route in routes.values():
+            _add_shapes_to_route(route, shapes, stops, shape_cache, shape_memo, stats)
 
     logging.debug('shape encoding stats: {}'.format(stats))
+    if shape_cache is not None:
+        encoding_cache.evict(shape_cache)
+    return stats['shapes']
+
+
+def _get_empty_shape_stats():
+    return {'shapes': 0, 'points': 0, 'dropped_points': 0, 'bytes': 0, 'cache_hits': 0,
+            'cache_misses': 0, 'memo_hits': 0, 'memo_misses': 0}
+
+
+def _add_shapes_to_route(route, shapes, stops, shape_cache, shape_memo, stats):
+    """Add shape index and stop distances to trips of route. Encodings are memoized in shape_memo
+    by shape_id and stop points so that each stop pattern of feed is encoded only once."""
+    cache = {}
+    shape_table = interning.create(route['shapes'])
+    for trip_id in route['trips']:
+        trip = route['trips'][trip_id]
+        if _is_shape_ok(route, trip, shapes):
+            cache_key = (trip['shape_id'], trip['stops'])
+            if cache_key in cache:
+                trip['stop_distances'] = cache[cache_key]['stop_distances']
+                trip['shape_i'] = cache[cache_key]['shape_i']
+            else:
+                shape = shapes[trip['shape_id']]['points']
+                stop_points = _get_trip_stop_points(trip['stops'], stops)
+                encoding = _get_memoized_shape_encoding(shapes, trip['shape_id'], stop_points,
+                                                        shape_cache, shape_memo, stats)
+                if _is_shape_long_enough(route, trip_id, shape, encoding['stop_distances'], stops):
+                    if encoding['encoded_shape'] is None:
+                        encoding['encoded_shape'] = encode_shape(shape,
+                                                                 encoding['stop_distances'])
+                        if shape_cache is not None:
+                            encoding_cache.put(shape_cache, encoding['key'], encoding)
+                    _add_shape_to_route(route, shape_table, trip, shape, encoding['encoded_shape'],
+                                        stats)
+                    cache[cache_key] = {
+                        'shape_i': trip['shape_i'],
+                        'stop_distances': trip['stop_distances']}
+                else:
+                    trip['is_invalid'] = True
+        else:
+            trip['is_invalid'] = True
+
+
+def encode_shape(points, fixed_indexes):
+    """Encode shape points like conversion does, see polyline.encode()."""
+    return polyline.encode(points, fixed_indexes, very_small=_VERY_SMALL)
+
+
+def _get_memoized_shape_encoding(shapes, shape_id, stop_points, shape_cache, shape_memo, stats):
+    """Get encoding of shape and stop points from memo of feed or from _get_shape_encoding(). Memo
+    holds the same dict which gets encoded shape added, so later routes reuse it."""
+    memo_key = (shape_id, tuple(stop_points))
+    if memo_key in shape_memo:
+        stats['memo_hits'] += 1
+    else:
+        stats['memo_misses'] += 1
+        shape_memo[memo_key] = _get_shape_encoding(shapes[shape_id], stop_points, shape_cache,
+                                                   stats)
+    return shape_memo[memo_key]
+
+
+def _get_shape_encoding(shape, stop_points, shape_cache, stats):
+    """Get stop distances and encoded shape (None if not encoded yet) from cache or get new stop
+    distances."""
+    key = None
+    if shape_cache is not None:
+        key = encoding_cache.get_key(shape['points'], stop_points, _VERY_SMALL)
+        encoding = encoding_cache.get(shape_cache, key)
+        if (encoding is not None) and (encoding['encoded_shape'] is not None):
+            stats['cache_hits'] += 1
+            return encoding
+        stats['cache_misses'] += 1
+    point_index = _get_shape_point_index(shape)
+    return {'key': key,
+            'stop_distances': _get_stop_distances(shape['points'], point_index, stop_points),
+            'encoded_shape': None}
+
+
+_SHAPE_WORKER_DATA = {}  # shapes, stops, shape cache and shape memo of worker process
+
+
+def _add_shapes_to_routes_in_parallel(routes, shapes, stops, jobs, shape_cache, stats):
+    """Add shapes to routes in worker processes. Shapes and stops are given to each worker once
+    (inherited without pickling when processes are forked) and only fields needed for encoding are
+    sent per route. Results are merged in route order so output does not depend on jobs."""
+    shape_routes = [_get_shape_route(route) for route in routes.values()]
+    with multiprocessing.Pool(jobs, initializer=_init_shape_worker,
+                              initargs=(shapes, stops, shape_cache)) as pool:
+        results = pool.imap(_add_shapes_to_shape_route, shape_routes)
+        for route, (shape_route, route_stats) in zip(routes.values(), results):
+            _merge_shape_route(route, shape_route)
+            for stat_name in stats:
+                stats[stat_name] += route_stats[stat_name]
+
+
+def _get_shape_route(route):
+    """Get copy of route with only fields used by _add_shapes_to_route()."""
+    shape_trips = collections.OrderedDict()
+    for trip_id, trip in route['trips'].items():
+        shape_trips[trip_id] = {
+            'shape_id': trip['shape_id'],
+            'stops': trip['stops'],
+            'stop_distances': trip['stop_distances'],
+            'shape_i': trip['shape_i'],
+            'is_invalid': trip['is_invalid']
+        }
+    return {'route_id': route['route_id'], 'name': route['name'],
+            'long_name': route['long_name'], 'trips': shape_trips, 'shapes': route['shapes']}
+
+
+def _init_shape_worker(shapes, stops, shape_cache):
+    _SHAPE_WORKER_DATA['shapes'] = shapes
+    _SHAPE_WORKER_DATA['stops'] = stops
+    _SHAPE_WORKER_DATA['shape_cache'] = shape_cache
+    _SHAPE_WORKER_DATA['shape_memo'] = {}
+
+
+def _add_shapes_to_shape_route(shape_route):
+    stats = _get_empty_shape_stats()
+    _add_shapes_to_route(shape_route, _SHAPE_WORKER_DATA['shapes'], _SHAPE_WORKER_DATA['stops'],
+                         _SHAPE_WORKER_DATA['shape_cache'], _SHAPE_WORKER_DATA['shape_memo'],
+                         stats)
+    return (shape_route, stats)
+
+
+def _merge_shape_route(route, shape_route):
+    route['shapes'] = shape_route['shapes']
+    for trip_id, shape_trip in shape_route['trips'].items():
+        trip = route['trips'][trip_id]
+        trip['shape_id'] = shape_trip['shape_id']
+        trip['stop_distances'] = shape_trip['stop_distances']
+        trip['shape_i'] = shape_trip['shape_i']
+        trip['is_invalid'] = shape_trip['is_invalid']
 
 
 def _is_shape_ok(route, trip, shapes):
@@ -449,19 +835,33 @@ def _is_shape_ok(route, trip, shapes):
         return True
 
 
-def _get_stop_distances(shape, trip_stops, stops):
-    stop_distances = []
+def _get_shape_point_index(shape):
+    """Get spatial index of shape points, created once and shared by all trips of the shape."""
+    if shape['point_index'] is None:
+        shape['point_index'] = polyline.create_point_index(shape['points'])
+    return shape['point_index']
+
 
-    for _, stop_id in sorted(trip_stops.items()):
+def _get_trip_stop_points(trip_stops, stops):
+    stop_points = []
+    for stop_id in trip_stops:
         if stop_id not in stops:
             logging.error('No stop information for stop_id={}.'.format(stop_id))
         else:
-            if len(stop_distances) == 0:
-                previous_index = 0
-            else:
-                previous_index = stop_distances[-1]
-            point_index = polyline.get_point_index(shape, stops[stop_id], previous_index)
-            stop_distances.append(point_index)
+            stop_points.append(stops[stop_id])
+    return stop_points
+
+
+def _get_stop_distances(shape, point_index, stop_points):
+    stop_distances = []
+
+    for stop_point in stop_points:
+        if len(stop_distances) == 0:
+            previous_index = 0
+        else:
+            previous_index = stop_distances[-1]
+        stop_distances.append(polyline.get_point_index(shape, stop_point, previous_index,
+                                                       point_index))
 
     return stop_distances
 
@@ -485,7 +885,7 @@ def _is_shape_long_enough(route, trip_id, shape, stop_distances, stops):
 def _count_unique_stops_in_trip(trip_stops, stops):
     unique_stops = 0
     previous_stop = None
-    for _, stop_id in sorted(trip_stops.items()):
+    for stop_id in trip_stops:
         if stop_id in stops:
             if stops[stop_id] != previous_stop:
                 unique_stops += 1
@@ -493,15 +893,14 @@ def _count_unique_stops_in_trip(trip_stops, stops):
     return unique_stops
 
 
-def _add_shape_to_route(route, trip, shape, stop_distances, stats):
-    encoded_shape = polyline.encode(shape, stop_distances, very_small=0.00002)
+def _add_shape_to_route(route, shape_table, trip, shape, encoded_shape, stats):
     trip['stop_distances'] = encoded_shape['fixed_indexes']
-    if encoded_shape['points'] in route['shapes']:
+    shape_i = interning.find_index(shape_table, encoded_shape['points'])
+    if shape_i is not None:
         logging.info('Duplicate shape encoding for route={}.'.format(route['long_name']))
-        trip['cache_indexes']['shape_i'] = route['shapes'].index(encoded_shape['points'])
+        trip['shape_i'] = shape_i
     else:
-        route['shapes'].append(encoded_shape['points'])
-        trip['cache_indexes']['shape_i'] = len(route['shapes']) - 1
+        trip['shape_i'] = interning.get_index(shape_table, encoded_shape['points'])
         stats['shapes'] += 1
         stats['points'] += len(shape)
         stats['dropped_points'] += encoded_shape['num_dropped_points']
@@ -529,12 +928,40 @@ def _delete_invalid_routes(routes):
         del routes[route_id]
 
 
-def get_modification_time(input_dir_or_zip):
+def get_modification_time(feed):
     """Get time of most recent content modification as seconds since the epoch."""
     path = 'routes.txt'
-    if os.path.isdir(input_dir_or_zip):
-        return int(os.stat(os.path.join(input_dir_or_zip, path)).st_mtime)
+    if feed['zip_file'] is None:
+        return int(os.stat(os.path.join(feed['path'], path)).st_mtime)
     else:
-        with zipfile.ZipFile(input_dir_or_zip) as zip_file:
-            modified_dt = datetime.datetime(*zip_file.getinfo(path).date_time)
-            return int(time.mktime(modified_dt.timetuple()))
+        modified_dt = datetime.datetime(*feed['members'][path].date_time)
+        return int(time.mktime(modified_dt.timetuple()))
+
+
+_SNAPSHOT_VERSION = 2  # increase when structure of routes changes
+
+
+def save_snapshot(routes, gtfs_modification_time, snapshot_filename):
+    """Save parsed GTFS routes and modification time into binary snapshot file."""
+    snapshot = {
+        'version': _SNAPSHOT_VERSION,
+        'gtfs_modification_time': gtfs_modification_time,
+        'routes': routes
+    }
+    with open(snapshot_filename, 'wb') as snapshot_file:
+        pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    logging.debug('saved {} routes into {}'.format(len(routes), snapshot_filename))
+
+
+def load_snapshot(snapshot_filename):
+    """Load (routes, gtfs_modification_time) from snapshot file created by save_snapshot(). The
+    file is memory mapped and unpickled without reading it into memory first. Load only trusted
+    snapshot files."""
+    with open(snapshot_filename, 'rb') as snapshot_file:
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot_data:
+            snapshot = pickle.loads(snapshot_data)
+    if snapshot.get('version') != _SNAPSHOT_VERSION:
+        raise SystemExit('snapshot version {} != {} in {}'.format(
+            snapshot.get('version'), _SNAPSHOT_VERSION, snapshot_filename))
+    logging.debug('loaded {} routes from {}'.format(len(snapshot['routes']), snapshot_filename))
+    return (snapshot['routes'], snapshot['gtfs_modification_time'])
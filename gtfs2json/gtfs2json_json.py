@@ -5,45 +5,376 @@ JSON: http://www.json.org/
 Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
 """
 
+import array
 import collections
+import datetime
 import json
 import logging
+import multiprocessing
+import operator
 import os
 import time
 
+import binary_format
+import interning
+import phase_metrics
+import polyline
+
 
 def create(routes, output_filename, gtfs_modification_time):
     """Create JSON file from parsed GTFS routes."""
-    array_keys = _get_array_keys()
-    output_route_types = _get_output_route_types()
-    output_dates = _get_output_dates(routes)
-    output_routes = _get_output_routes(array_keys, output_dates, routes)
+    create_files(routes, [{'filename': output_filename, 'route_ids': list(routes)}],
+                 gtfs_modification_time)
+
+
+def create_files(routes, output_files, gtfs_modification_time, jobs=1, metrics=None,
+                 trip_slice_minutes=None, date_bitmaps=False, shared_strings=False):
+    """Create JSON files from parsed GTFS routes, each output file with its own route_ids."""
+    array_keys = _get_array_keys(trip_slice_minutes, date_bitmaps, shared_strings)
+    route_ids = set()
+    for output_file in output_files:
+        route_ids.update(output_file['route_ids'])
+    with phase_metrics.measure(metrics, 'get_service_trip_dates') as phase:
+        service_trip_dates = _get_service_trip_dates(array_keys, routes, route_ids)
+        phase['count'] = len(service_trip_dates)
+    with phase_metrics.measure(metrics, 'get_date_counts') as phase:
+        date_counts = {}  # by route_id
+        for route_id in route_ids:
+            date_counts[route_id] = _get_route_date_counts(array_keys, routes[route_id],
+                                                           service_trip_dates)
+        phase['count'] = len(date_counts)
+
+    with phase_metrics.measure(metrics, 'write_files') as phase:
+        if jobs > 1:
+            shared_routes = {}  # output routes and trip slices by route_id
+            for route_id in sorted(route_ids):
+                shared_routes[route_id] = _get_shared_output_route(
+                    array_keys, routes[route_id], service_trip_dates, trip_slice_minutes)
+            with multiprocessing.Pool(jobs, initializer=_init_file_worker,
+                                      initargs=(array_keys, shared_routes, date_counts,
+                                                gtfs_modification_time)) as pool:
+                pool.map(_create_worker_file, output_files, chunksize=1)
+        else:
+            writers = [_open_output_file(array_keys, date_counts, output_file,
+                                         gtfs_modification_time)
+                       for output_file in output_files]
+            try:
+                for route_id in sorted(route_ids):
+                    shared_route = _get_shared_output_route(
+                        array_keys, routes[route_id], service_trip_dates, trip_slice_minutes)
+                    for writer in writers:
+                        if route_id in writer['route_ids']:
+                            _write_output_route(array_keys, writer, shared_route)
+            finally:
+                for writer in writers:
+                    _close_output_file(writer)
+        phase['count'] = sum(len(output_file['route_ids']) for output_file in output_files)
+
+
+_FILE_WORKER_DATA = {}  # arguments of _create_file() shared by all files of worker process
+
+
+def _init_file_worker(array_keys, shared_routes, date_counts, gtfs_modification_time):
+    _FILE_WORKER_DATA['array_keys'] = array_keys
+    _FILE_WORKER_DATA['shared_routes'] = shared_routes
+    _FILE_WORKER_DATA['date_counts'] = date_counts
+    _FILE_WORKER_DATA['gtfs_modification_time'] = gtfs_modification_time
+
+
+def _create_worker_file(output_file):
+    _create_file(_FILE_WORKER_DATA['array_keys'], _FILE_WORKER_DATA['shared_routes'],
+                 _FILE_WORKER_DATA['date_counts'], output_file,
+                 _FILE_WORKER_DATA['gtfs_modification_time'])
+
+
+def _create_file(array_keys, shared_routes, date_counts, output_file, gtfs_modification_time):
+    writer = _open_output_file(array_keys, date_counts, output_file, gtfs_modification_time)
+    try:
+        for route_id in sorted(output_file['route_ids']):
+            _write_output_route(array_keys, writer, shared_routes[route_id])
+    finally:
+        _close_output_file(writer)
+
+
+def _open_output_file(array_keys, date_counts, output_file, gtfs_modification_time):
+    """Open output file and write root items before routes into it."""
+    logging.debug('creating {}'.format(output_file['filename']))
+    output_dates = _get_output_dates(date_counts, output_file['route_ids'])
+    shard_routes = output_file.get('shard_routes')
+    if shard_routes:
+        array_keys = _get_manifest_array_keys(array_keys)
 
     output_data = [None] * len(array_keys['root'])
     output_data[array_keys['root']['array_keys']] = array_keys
     output_data[array_keys['root']['gtfs_epoch']] = gtfs_modification_time
     output_data[array_keys['root']['json_epoch']] = int(time.time())
-    output_data[array_keys['root']['route_types']] = output_route_types
+    output_data[array_keys['root']['route_types']] = _get_output_route_types()
     output_data[array_keys['root']['dates']] = output_dates
-    output_data[array_keys['root']['routes']] = output_routes
 
-    with open(output_filename, 'w') as output_file:
-        output_file.write(json.dumps(output_data, separators=(',', ':')))
-
-
-def _get_array_keys():
+    writer = {
+        'array_keys': array_keys,
+        'filename': output_file['filename'],
+        'file': None,
+        'route_ids': set(output_file['route_ids']),
+        'output_dates': interning.create(output_dates),
+        'route_types': set(),
+        'stats': {'route_ids': 0, 'shapes': 0},
+        'shared_strings': None,
+        'trip_buckets': None,  # trip slices by start time of bucket
+        'shard_routes': shard_routes,
+        'manifest': None,
+        'open_shards': {},  # by route type
+        'binary': None
+    }
+    if 'shapes' in array_keys['root']:
+        writer['shared_strings'] = collections.OrderedDict(
+            (value_name, interning.create()) for value_name in _SHARED_STRING_NAMES)
+        writer['stats'].update({'removed_strings': 0, 'removed_bytes': 0, 'index_bytes': 0})
+    if 'trip_buckets' in array_keys['root']:
+        writer['trip_buckets'] = {}
+    if shard_routes:
+        output_data[array_keys['root']['routes']] = []
+        output_data[array_keys['root']['shards']] = []
+        writer['manifest'] = {'array_keys': array_keys, 'data': output_data}
+    else:
+        closing_items = len(writer['shared_strings'] or {})
+        if writer['trip_buckets'] is not None:
+            closing_items += 1
+        if array_keys['root']['routes'] != (len(array_keys['root']) - 1 - closing_items):
+            msg = 'routes must be followed only by shared strings and trip buckets in root: {}'
+            raise SystemExit(msg.format(array_keys['root']))
+        writer['file'] = open(output_file['filename'], 'w')
+        root_json = _to_json(output_data[:array_keys['root']['routes']])
+        writer['file'].write(root_json[:-1] + ',[')  # '[...]' -> '[...,['
+        if output_file.get('binary_filename'):
+            writer['binary'] = binary_format.open_writer(output_file['binary_filename'])
+            binary_format.start_open_list(writer['binary'])
+            for root_item in output_data[:array_keys['root']['routes']]:
+                binary_format.write_value(writer['binary'], root_item)
+            binary_format.start_open_list(writer['binary'])
+    return writer
+
+
+def _get_manifest_array_keys(array_keys):
+    """Get array keys of manifest: routes of root are manifest routes and root has also shards."""
+    manifest_array_keys = {node: dict(keys) for node, keys in array_keys.items()}
+    manifest_array_keys['root']['shards'] = len(array_keys['root'])
+    manifest_array_keys['manifest_route'] = {'id': 0, 'name': 1, 'type': 2, 'shard_i': 3,
+                                             'offset': 4, 'size': 5}
+    manifest_array_keys['shard'] = {'filename': 0, 'type': 1}
+    return manifest_array_keys
+
+
+def _write_output_route(array_keys, writer, shared_output_route):
+    """Write route with date indexes of output file in trip dates."""
+    output_route = list(shared_output_route['route'])
+    output_route[array_keys['route']['trip_dates']] = [
+        _get_output_trip_dates(array_keys, trip_dates, writer['output_dates'])
+        for trip_dates in output_route[array_keys['route']['trip_dates']]]
+    if writer['shared_strings'] is not None:
+        for value_name in writer['shared_strings']:
+            output_route[array_keys['route'][value_name]] = _get_shared_string_indexes(
+                writer, value_name, output_route[array_keys['route'][value_name]])
+    if writer['shard_routes']:
+        _write_shard_route(array_keys, writer, output_route)
+    else:
+        if writer['stats']['route_ids'] > 0:
+            writer['file'].write(',')
+        writer['file'].write(_to_json(output_route))
+        if writer['binary'] is not None:
+            binary_format.write_value(writer['binary'],
+                                      _get_binary_output_route(array_keys, output_route))
+    if writer['trip_buckets'] is not None:
+        for start_time, trip_slices in shared_output_route['trip_slices'].items():
+            if start_time not in writer['trip_buckets']:
+                writer['trip_buckets'][start_time] = []
+            writer['trip_buckets'][start_time].extend(trip_slices)
+    writer['route_types'].add(output_route[array_keys['route']['type']])
+    writer['stats']['route_ids'] += 1
+    writer['stats']['shapes'] += len(output_route[array_keys['route']['shapes']])
+
+
+def _get_shared_string_indexes(writer, value_name, values):
+    """Get indexes of route values in shared table of output file."""
+    table = writer['shared_strings'][value_name]
+    indexes = []
+    for value in values:
+        if interning.find_index(table, value) is not None:
+            writer['stats']['removed_strings'] += 1
+            writer['stats']['removed_bytes'] += len(_to_json(value))
+        indexes.append(interning.get_index(table, value))
+    writer['stats']['index_bytes'] += len(_to_json(indexes)) - 2
+    return indexes
+
+
+def _write_shard_route(array_keys, writer, output_route):
+    """Write route into shard file of its route type and add it into manifest."""
+    route_type = output_route[array_keys['route']['type']]
+    if route_type not in writer['open_shards']:
+        _open_shard(writer, route_type)
+    shard = writer['open_shards'][route_type]
+    if shard['route_count'] > 0:
+        shard['file'].write(',')
+        shard['size'] += 1
+    route_json = _to_json(output_route)  # ASCII only, so number of characters is number of bytes
+    shard['file'].write(route_json)
+
+    manifest_keys = writer['manifest']['array_keys']
+    manifest_route = [None] * len(manifest_keys['manifest_route'])
+    manifest_route[manifest_keys['manifest_route']['id']] = output_route[array_keys['route']['id']]
+    manifest_route[manifest_keys['manifest_route']['name']] = \
+        output_route[array_keys['route']['name']]
+    manifest_route[manifest_keys['manifest_route']['type']] = route_type
+    manifest_route[manifest_keys['manifest_route']['shard_i']] = shard['shard_i']
+    manifest_route[manifest_keys['manifest_route']['offset']] = shard['size']
+    manifest_route[manifest_keys['manifest_route']['size']] = len(route_json)
+    writer['manifest']['data'][manifest_keys['root']['routes']].append(manifest_route)
+
+    shard['size'] += len(route_json)
+    shard['route_count'] += 1
+    if shard['route_count'] == writer['shard_routes']:
+        _close_shard(writer, route_type)
+
+
+def _open_shard(writer, route_type):
+    manifest_keys = writer['manifest']['array_keys']
+    manifest_shards = writer['manifest']['data'][manifest_keys['root']['shards']]
+    shard_i = len(manifest_shards)
+    filename = '{}_{}.json'.format(os.path.splitext(writer['filename'])[0], shard_i)
+    manifest_shard = [None] * len(manifest_keys['shard'])
+    manifest_shard[manifest_keys['shard']['filename']] = os.path.basename(filename)
+    manifest_shard[manifest_keys['shard']['type']] = route_type
+    manifest_shards.append(manifest_shard)
+    writer['open_shards'][route_type] = {'shard_i': shard_i, 'file': open(filename, 'w'),
+                                         'route_count': 0, 'size': 1}
+    writer['open_shards'][route_type]['file'].write('[')
+
+
+def _close_shard(writer, route_type):
+    shard = writer['open_shards'].pop(route_type)
+    shard['file'].write(']')
+    shard['file'].close()
+
+
+def _close_output_file(writer):
+    if writer['shard_routes']:
+        for route_type in list(writer['open_shards']):
+            _close_shard(writer, route_type)
+        manifest_keys = writer['manifest']['array_keys']
+        if writer['shared_strings'] is not None:
+            for value_name, table in writer['shared_strings'].items():
+                writer['manifest']['data'][manifest_keys['root'][value_name]] = table['values']
+        if writer['trip_buckets'] is not None:
+            writer['manifest']['data'][manifest_keys['root']['trip_buckets']] = \
+                _write_trip_buckets(writer)
+        with open(writer['filename'], 'w') as output_file:
+            output_file.write(_to_json(writer['manifest']['data']))
+        logging.debug('shards: {}'.format(len(writer['manifest']['data'][
+            writer['manifest']['array_keys']['root']['shards']])))
+    else:
+        writer['file'].write(']')
+        if writer['binary'] is not None:
+            binary_format.end_open_list(writer['binary'])
+        if writer['shared_strings'] is not None:
+            for value_name, table in writer['shared_strings'].items():
+                writer['file'].write(',' + _to_json(table['values']))
+                if writer['binary'] is not None:
+                    binary_format.write_value(writer['binary'], _get_binary_output_values(
+                        value_name, table['values']))
+        if writer['trip_buckets'] is not None:
+            writer['file'].write(',' + _to_json(_write_trip_buckets(writer)))
+        writer['file'].write(']')
+        writer['file'].close()
+        if writer['binary'] is not None:
+            binary_format.end_open_list(writer['binary'])
+            binary_format.close_writer(writer['binary'])
+    logging.debug('route types: {}'.format(sorted(writer['route_types'])))
+    logging.debug('output stats: {}'.format(writer['stats']))
+
+
+def _write_trip_buckets(writer):
+    """Write trip slices of each bucket into its own file and get buckets for root."""
+    array_keys = writer['array_keys']
+    output_trip_buckets = []
+    for start_time, trip_slices in sorted(writer['trip_buckets'].items()):
+        filename = '{}_t{}.json'.format(os.path.splitext(writer['filename'])[0], start_time)
+        with open(filename, 'w') as bucket_file:
+            bucket_file.write(_to_json(trip_slices))
+        output_trip_bucket = [None] * len(array_keys['trip_bucket'])
+        output_trip_bucket[array_keys['trip_bucket']['filename']] = os.path.basename(filename)
+        output_trip_bucket[array_keys['trip_bucket']['start_time']] = start_time
+        output_trip_bucket[array_keys['trip_bucket']['end_time']] = max(
+            trip_slice[array_keys['trip_slice']['end_time']] for trip_slice in trip_slices)
+        output_trip_buckets.append(output_trip_bucket)
+    logging.debug('trip buckets: {}'.format(len(output_trip_buckets)))
+    return output_trip_buckets
+
+
+def _get_binary_output_route(array_keys, output_route):
+    """Get route with integer arrays instead of packed integer lists and encoded shapes."""
+    binary_route = list(output_route)
+    for value_name in _SHARED_STRING_NAMES:
+        if value_name not in array_keys['root']:
+            binary_route[array_keys['route'][value_name]] = _get_binary_output_values(
+                value_name, output_route[array_keys['route'][value_name]])
+    binary_directions = []
+    for direction in output_route[array_keys['route']['directions']]:
+        binary_direction = list(direction)
+        binary_direction[array_keys['direction']['trips']] = _get_binary_output_trips(
+            array_keys, direction[array_keys['direction']['trips']])
+        binary_directions.append(binary_direction)
+    binary_route[array_keys['route']['directions']] = binary_directions
+    return binary_route
+
+
+def _get_binary_output_values(value_name, values):
+    if value_name == 'shapes':
+        return [array.array('i', polyline.decode_deltas(shape)) for shape in values]
+    return [array.array('i', _string_to_integer_list(value)) for value in values]
+
+
+def _get_binary_output_trips(array_keys, trips):
+    if not trips:
+        return trips
+    binary_trips = list(trips)
+    for value_name in ['start_times', 'stop_times_indexes', 'trip_group_indexes']:
+        binary_trips[array_keys['trip'][value_name]] = array.array(
+            'i', _string_to_integer_list(trips[array_keys['trip'][value_name]]))
+    return binary_trips
+
+
+_SHARED_STRING_NAMES = ['shapes', 'stop_distances', 'stop_times']  # route values in shared tables
+
+
+def _to_json(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def _get_array_keys(trip_slice_minutes=None, date_bitmaps=False, shared_strings=False):
     array_keys = {}
     array_keys['root'] = {'array_keys': 0, 'gtfs_epoch': 1, 'json_epoch': 2, 'route_types': 3,
                           'dates': 4, 'routes': 5}
+    if shared_strings:
+        for value_name in _SHARED_STRING_NAMES:
+            array_keys['root'][value_name] = len(array_keys['root'])
+    if trip_slice_minutes:
+        array_keys['root']['trip_buckets'] = len(array_keys['root'])
     array_keys['route'] = {'id': 0, 'name': 1, 'long_name': 2, 'type': 3, 'shapes': 4,
                            'stop_distances': 5, 'trip_dates': 6, 'trip_groups': 7, 'stop_times': 8,
                            'is_departure_times': 9, 'directions': 10}
-    array_keys['trip_dates'] = {'start_date_i': 0, 'end_date_i': 1, 'weekdays': 2,
-                                'added': 3, 'removed': 4}
+    if date_bitmaps:
+        array_keys['trip_dates'] = {'start_date_i': 0, 'active_days': 1}
+    else:
+        array_keys['trip_dates'] = {'start_date_i': 0, 'end_date_i': 1, 'weekdays': 2,
+                                    'added': 3, 'removed': 4}
     array_keys['trip_group'] = {'shape_i': 0, 'stop_distances_i': 1, 'trip_dates_i': 2}
     array_keys['direction'] = {'trips': 0}
     array_keys['trip'] = {'first_start_time': 0, 'start_times': 1, 'stop_times_indexes': 2,
                           'trip_group_indexes': 3}
+    if trip_slice_minutes:
+        array_keys['trip_bucket'] = {'filename': 0, 'start_time': 1, 'end_time': 2}
+        array_keys['trip_slice'] = {'route_id': 0, 'direction_i': 1, 'start_time': 2,
+                                    'end_time': 3, 'first_trip_i': 4, 'trips': 5}
     return array_keys
 
 
@@ -54,156 +385,260 @@ def _get_output_route_types():
     return route_types
 
 
-def _get_output_dates(routes):
+def _get_service_trip_dates(array_keys, routes, route_ids):
+    """Get trip dates (with dates, see _get_output_trip_dates()) of each service by service_id."""
+    service_trip_dates = {}
+    for route_id in route_ids:
+        for trip in routes[route_id]['trips'].values():
+            if trip['service_id'] not in service_trip_dates:
+                if 'active_days' in array_keys['trip_dates']:
+                    trip_dates = _get_bitmap_trip_dates(array_keys, trip['dates'])
+                else:
+                    trip_dates = _get_service_dates_trip_dates(array_keys, trip['dates'])
+                service_trip_dates[trip['service_id']] = trip_dates
+    return service_trip_dates
+
+
+def _get_route_date_counts(array_keys, route, service_trip_dates):
+    date_counts = collections.OrderedDict()
+    for trip in route['trips'].values():
+        for date in _get_trip_dates_dates(array_keys, service_trip_dates[trip['service_id']]):
+            if date not in date_counts:
+                date_counts[date] = 0
+            date_counts[date] += 1
+    return date_counts
+
+
+def _get_trip_dates_dates(array_keys, trip_dates):
+    """Get dates in trip dates in order of array keys."""
+    dates = []
+    for date_key in ['start_date_i', 'end_date_i']:
+        if date_key in array_keys['trip_dates']:
+            dates.append(trip_dates[array_keys['trip_dates'][date_key]])
+    for exception_type in ['added', 'removed']:
+        if exception_type in array_keys['trip_dates']:
+            dates.extend(trip_dates[array_keys['trip_dates'][exception_type]])
+    return dates
+
+
+def _get_output_dates(date_counts, route_ids):
     output_dates = collections.OrderedDict()
-    for route in routes.values():
-        for trip in route['trips'].values():
-            dates = [trip['dates']['start_date'], trip['dates']['end_date']]
-            for exception_dates in trip['dates']['exception_dates'].values():
-                dates = dates + exception_dates
-            for date in dates:
-                if date not in output_dates:
-                    output_dates[date] = 0
-                output_dates[date] += 1
+    for route_id in route_ids:
+        for date, count in date_counts[route_id].items():
+            if date not in output_dates:
+                output_dates[date] = 0
+            output_dates[date] += count
 
     return sorted(output_dates, key=output_dates.get, reverse=True)
 
 
-def _get_output_routes(array_keys, output_dates, routes):
-    output_routes = []
-    route_types = set()
-    stats = {'route_ids': len(routes), 'shapes': 0}
-
-    for route_id in sorted(routes):
-        route = routes[route_id]
-        route_types.add(route['type'])
-        output_values = _get_route_trips_output_values(
-            array_keys, route['trips'], route['is_departure_times'], output_dates)
-        output_trip_groups = _get_route_trips_groups(array_keys, route['trips'])
-        # cache indexes must be set before this
-        output_directions = _get_output_directions(array_keys, route['trips'])
-        output_route = [None] * len(array_keys['route'])
-        output_route[array_keys['route']['id']] = route['route_id']
-        output_route[array_keys['route']['name']] = route['name']
-        output_route[array_keys['route']['long_name']] = route['long_name']
-        output_route[array_keys['route']['type']] = route['type']
-        output_route[array_keys['route']['shapes']] = route['shapes']
-        output_route[array_keys['route']['stop_distances']] = output_values['stop_distances']
-        output_route[array_keys['route']['trip_dates']] = output_values['trip_dates']
-        output_route[array_keys['route']['trip_groups']] = output_trip_groups
-        output_route[array_keys['route']['stop_times']] = output_values['stop_times']
-        output_route[array_keys['route']['is_departure_times']] = int(route['is_departure_times'])
-        output_route[array_keys['route']['directions']] = output_directions
-        output_routes.append(output_route)
-        stats['shapes'] += len(route['shapes'])
-
-    logging.debug('route types: {}'.format(sorted(route_types)))
-    logging.debug('output stats: {}'.format(stats))
-
-    return output_routes
-
-
-def _get_route_trips_output_values(array_keys, trips, is_departure_times, output_dates):
-    output_values = {'stop_distances': [], 'stop_times': [], 'trip_dates': []}
+def _get_shared_output_route(array_keys, route, service_trip_dates, trip_slice_minutes=None):
+    output_values = _get_route_trips_output_values(array_keys, route['trips'],
+                                                   route['is_departure_times'], service_trip_dates)
+    output_trip_groups = _get_route_trips_groups(array_keys, route['trips'])
+    # cache indexes must be set before this
+    output_directions = _get_output_directions(array_keys, route['trips'], trip_slice_minutes)
+    output_route = [None] * len(array_keys['route'])
+    output_route[array_keys['route']['id']] = route['route_id']
+    output_route[array_keys['route']['name']] = route['name']
+    output_route[array_keys['route']['long_name']] = route['long_name']
+    output_route[array_keys['route']['type']] = route['type']
+    output_route[array_keys['route']['shapes']] = route['shapes']
+    output_route[array_keys['route']['stop_distances']] = output_values['stop_distances']
+    output_route[array_keys['route']['trip_dates']] = output_values['trip_dates']
+    output_route[array_keys['route']['trip_groups']] = output_trip_groups
+    output_route[array_keys['route']['stop_times']] = output_values['stop_times']
+    output_route[array_keys['route']['is_departure_times']] = int(route['is_departure_times'])
+    output_route[array_keys['route']['directions']] = output_directions
+    output_trip_slices = None
+    if trip_slice_minutes:
+        output_trip_slices = _get_output_trip_slices(array_keys, route['route_id'],
+                                                     route['trips'], trip_slice_minutes)
+    return {'route': output_route, 'trip_slices': output_trip_slices}
+
+
+def _get_route_trips_output_values(array_keys, trips, is_departure_times, service_trip_dates):
+    output_values = {'stop_distances': interning.create(), 'stop_times': interning.create(),
+                     'trip_dates': interning.create()}
     get_new_value = {
         'stop_distances': _get_new_value_stop_distances,
-        'stop_times': _get_new_value_stop_times,
-        'trip_dates': _get_new_value_trip_dates,
+        'stop_times': _get_new_value_stop_times
     }
+    trip_dates_indexes = {}  # by service_id
     for trip in trips.values():
-        trip['times']['is_departure_times'] = is_departure_times
-        for value_name in output_values:
-            new_value = get_new_value[value_name](array_keys, trip, output_dates)
-            trip['cache_indexes'][value_name + '_i'] = _get_cache_index(output_values[value_name],
-                                                                        new_value)
-    return output_values
-
-
-def _get_new_value_stop_distances(_, trip, dummy):
+        trip['is_departure_times'] = is_departure_times
+        for value_name in get_new_value:
+            new_value = get_new_value[value_name](array_keys, trip)
+            trip[value_name + '_i'] = interning.get_index(
+                output_values[value_name], new_value)
+        if trip['service_id'] not in trip_dates_indexes:
+            trip_dates_indexes[trip['service_id']] = interning.get_index(
+                output_values['trip_dates'], service_trip_dates[trip['service_id']])
+        trip['trip_dates_i'] = trip_dates_indexes[trip['service_id']]
+    return {value_name: output_values[value_name]['values'] for value_name in output_values}
+
+
+def _get_new_value_stop_distances(_, trip):
     delta_stop_distances = _get_delta_list(trip['stop_distances'])
     return _integer_list_to_string(delta_stop_distances)
 
 
-def _get_cache_index(cache_values, new_value):
-    try:
-        return cache_values.index(new_value)
-    except ValueError:
-        cache_values.append(new_value)
-        return len(cache_values) - 1
-
-
 def _get_route_trips_groups(array_keys, trips):
-    route_trip_groups = []
+    route_trip_groups = interning.create()
     for trip in trips.values():
-        cis = trip['cache_indexes']
         output_trip_group = [None] * len(array_keys['trip_group'])
-        output_trip_group[array_keys['trip_group']['shape_i']] = cis['shape_i']
-        output_trip_group[array_keys['trip_group']['stop_distances_i']] = cis['stop_distances_i']
-        output_trip_group[array_keys['trip_group']['trip_dates_i']] = cis['trip_dates_i']
-        cis['trip_group_i'] = _get_cache_index(route_trip_groups, output_trip_group)
-    return route_trip_groups
+        output_trip_group[array_keys['trip_group']['shape_i']] = trip['shape_i']
+        output_trip_group[array_keys['trip_group']['stop_distances_i']] = trip['stop_distances_i']
+        output_trip_group[array_keys['trip_group']['trip_dates_i']] = trip['trip_dates_i']
+        trip['trip_group_i'] = interning.get_index(route_trip_groups, output_trip_group)
+    return route_trip_groups['values']
 
 
-def _get_output_directions(array_keys, trips):
+def _get_output_directions(array_keys, trips, trip_slice_minutes):
     output_directions = []
-    if list(trips.values())[0]['direction_id'] == '-':
-        directions = ['-']
-    else:
-        directions = ['0', '1']
-    for direction in directions:
-        output_directions.append(_get_output_direction(array_keys, trips, direction))
+    for direction_id in _get_direction_ids(trips):
+        output_direction = [None] * len(array_keys['direction'])
+        if trip_slice_minutes:
+            output_direction[array_keys['direction']['trips']] = []  # trips are in trip buckets
+        else:
+            output_direction[array_keys['direction']['trips']] = _get_output_trips(
+                array_keys, trips, direction_id)
+        output_directions.append(output_direction)
     return output_directions
 
 
-def _get_output_direction(array_keys, trips, direction_id):
-    output_trips = _get_output_trips(array_keys, trips, direction_id)
-    output_direction = [None] * len(array_keys['direction'])
-    output_direction[array_keys['direction']['trips']] = output_trips
-    return output_direction
+def _get_direction_ids(trips):
+    if list(trips.values())[0]['direction_id'] == '-':
+        return ['-']
+    return ['0', '1']
+
+
+def _get_output_trip_slices(array_keys, route_id, input_trips, trip_slice_minutes):
+    """Get trip slices of route by start time of trip bucket (see _write_trip_buckets())."""
+    output_trip_slices = collections.OrderedDict()
+    for direction_i, direction_id in enumerate(_get_direction_ids(input_trips)):
+        slice_trips = collections.OrderedDict()  # trips by slice start time
+        for trip_id, trip in sorted(input_trips.items(),
+                                    key=lambda item: (item[1]['start_time'], item[0])):
+            if trip['direction_id'] == direction_id:
+                start_time = trip['start_time']
+                slice_start_time = start_time - (start_time % trip_slice_minutes)
+                if slice_start_time not in slice_trips:
+                    slice_trips[slice_start_time] = {}
+                slice_trips[slice_start_time][trip_id] = trip
+
+        first_trip_i = 0
+        for slice_start_time, trips in slice_trips.items():
+            output_trip_slice = [None] * len(array_keys['trip_slice'])
+            output_trip_slice[array_keys['trip_slice']['route_id']] = route_id
+            output_trip_slice[array_keys['trip_slice']['direction_i']] = direction_i
+            output_trip_slice[array_keys['trip_slice']['start_time']] = slice_start_time
+            output_trip_slice[array_keys['trip_slice']['end_time']] = max(
+                trip['start_time'] + trip['stop_times'][-1]
+                for trip in trips.values())
+            output_trip_slice[array_keys['trip_slice']['first_trip_i']] = first_trip_i
+            output_trip_slice[array_keys['trip_slice']['trips']] = _get_output_trips(
+                array_keys, trips, direction_id)
+            if slice_start_time not in output_trip_slices:
+                output_trip_slices[slice_start_time] = []
+            output_trip_slices[slice_start_time].append(output_trip_slice)
+            first_trip_i += len(trips)
+    return output_trip_slices
+
+
+def _get_service_dates_trip_dates(array_keys, dates):
+    """Get trip dates with dates of service, see _get_output_trip_dates() for date indexes."""
+    output_trip_dates = [None] * len(array_keys['trip_dates'])
+    output_trip_dates[array_keys['trip_dates']['start_date_i']] = dates['start_date']
+    output_trip_dates[array_keys['trip_dates']['end_date_i']] = dates['end_date']
+    output_trip_dates[array_keys['trip_dates']['weekdays']] = dates['weekdays']
+    exception_dates = dates['exception_dates']
+    output_trip_dates[array_keys['trip_dates']['added']] = list(exception_dates['added'])
+    output_trip_dates[array_keys['trip_dates']['removed']] = list(exception_dates['removed'])
+    return output_trip_dates
+
+
+_BITMAP_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
 
-def _get_new_value_trip_dates(array_keys, trip, output_dates):
-    start_date_i = output_dates.index(trip['dates']['start_date'])
-    end_date_i = output_dates.index(trip['dates']['end_date'])
-    exception_dates = _get_output_exception_dates(trip['dates']['exception_dates'], output_dates)
+def _get_bitmap_trip_dates(array_keys, dates):
+    """Get trip dates with first active date and bitmap of active days (six per character)."""
+    active_dates = sorted(_get_active_dates(dates))
+    if active_dates:
+        first_date = _parse_date(active_dates[0])
+        day_indexes = [(_parse_date(date) - first_date).days for date in active_dates]
+        bitmap = [0] * ((day_indexes[-1] // 6) + 1)
+        for day_i in day_indexes:
+            bitmap[day_i // 6] |= 1 << (day_i % 6)
+        active_days = ''.join(_BITMAP_CHARS[bits] for bits in bitmap)
+        start_date = active_dates[0]
+    else:
+        active_days = ''
+        start_date = dates['start_date'] or dates['exception_dates']['removed'][0]
     output_trip_dates = [None] * len(array_keys['trip_dates'])
-    output_trip_dates[array_keys['trip_dates']['start_date_i']] = start_date_i
-    output_trip_dates[array_keys['trip_dates']['end_date_i']] = end_date_i
-    output_trip_dates[array_keys['trip_dates']['weekdays']] = trip['dates']['weekdays']
-    output_trip_dates[array_keys['trip_dates']['added']] = exception_dates['added']
-    output_trip_dates[array_keys['trip_dates']['removed']] = exception_dates['removed']
+    output_trip_dates[array_keys['trip_dates']['start_date_i']] = start_date
+    output_trip_dates[array_keys['trip_dates']['active_days']] = active_days
     return output_trip_dates
 
 
-def _get_output_exception_dates(exception_dates, output_dates):
-    output_exception_dates = {'added': [], 'removed': []}
-    for exception_type in sorted(exception_dates):
-        for exception_date in exception_dates[exception_type]:
-            dates = output_exception_dates[exception_type]
-            dates.append(output_dates.index(exception_date))
-    return output_exception_dates
+def _get_active_dates(dates):
+    """Get set of dates (YYYYMMDD) when service is active."""
+    active_dates = set()
+    if dates['start_date'] is not None:
+        end_date = _parse_date(dates['end_date'])
+        date = _parse_date(dates['start_date'])
+        while date <= end_date:
+            if _is_weekday_in_weekdays(date.weekday(), dates['weekdays']):
+                active_dates.add(date.strftime('%Y%m%d'))
+            date += datetime.timedelta(days=1)
+    active_dates.difference_update(dates['exception_dates']['removed'])
+    active_dates.update(dates['exception_dates']['added'])
+    return active_dates
+
+
+def _is_weekday_in_weekdays(weekday, weekdays):  # 0=Monday, weekdays is 0-6 or like '1111100'
+    if isinstance(weekdays, int):
+        return weekday == weekdays
+    return weekdays[weekday] == '1'
+
+
+def _parse_date(date):  # YYYYMMDD
+    return datetime.date(int(date[:4]), int(date[4:6]), int(date[6:]))
+
+
+def _get_output_trip_dates(array_keys, trip_dates, output_dates):
+    """Replace dates in trip dates with their indexes in output_dates (interning table)."""
+    output_trip_dates = list(trip_dates)
+    for date_key in ['start_date_i', 'end_date_i']:
+        if date_key in array_keys['trip_dates']:
+            output_trip_dates[array_keys['trip_dates'][date_key]] = interning.get_index(
+                output_dates, trip_dates[array_keys['trip_dates'][date_key]])
+    for exception_type in ['added', 'removed']:
+        if exception_type in array_keys['trip_dates']:
+            output_trip_dates[array_keys['trip_dates'][exception_type]] = [
+                interning.get_index(output_dates, exception_date)
+                for exception_date in trip_dates[array_keys['trip_dates'][exception_type]]]
+    return output_trip_dates
 
 
-def _get_new_value_stop_times(_, trip, dummy):
-    trip_stop_times = _get_trip_stop_times(trip['times']['stop_times'],
-                                           trip['times']['is_departure_times'])
+def _get_new_value_stop_times(_, trip):
+    trip_stop_times = _get_trip_stop_times(trip['stop_times'],
+                                           trip['is_departure_times'])
     return _integer_list_to_string(_get_delta_list(trip_stop_times))
 
 
 def _get_trip_stop_times(stop_times, is_departure_times):
     if is_departure_times:
-        return stop_times  # get both arrival and departure times
+        return list(stop_times)  # get both arrival and departure times
     else:
-        return [t for i, t in enumerate(stop_times) if (i % 2) == 0]  # get only arrival times
+        return list(stop_times[::2])  # get only arrival times
 
 
 def _get_delta_list(integer_list):
     """For [0, 10, 11, 22, 25] return [10, 1, 11, 3]."""
     if (len(integer_list) > 0) and (integer_list[0] != 0):
         raise SystemExit('integer_list[0] = {} != 0'.format(integer_list[0]))
-    if integer_list != sorted(integer_list):
-        raise SystemExit('integer_list not sorted: {}'.format(integer_list))
-    return [(integer_list[i] - integer_list[i - 1]) for i in range(1, len(integer_list))]
+    return list(map(operator.sub, integer_list[1:], integer_list))
 
 
 def _integer_list_to_string(integer_list):
@@ -222,17 +657,33 @@ def _integer_list_to_string(integer_list):
     return output_string
 
 
+def _string_to_integer_list(string):
+    """For '#$%1~!$2!~!!$3' return [0, 1, 2, 14, 91, 92, 15, 182, 183, 16]."""
+    mult_chr = 33  # 33='!'
+    min_chr = 35  # 35='#'
+    max_value = 126 - min_chr  # 126='~'
+    integer_list = []
+    integer = 0
+    for char in string:
+        if ord(char) == mult_chr:
+            integer += max_value
+        else:
+            integer_list.append(integer + ord(char) - min_chr)
+            integer = 0
+    return integer_list
+
+
 def _get_output_trips(array_keys, input_trips, direction_id):
     trips = {}  # by start time
 
     for _, trip in sorted(input_trips.items()):
         if trip['direction_id'] == direction_id:
-            start_time = trip['times']['start_time']
+            start_time = trip['start_time']
             if start_time not in trips:
                 trips[start_time] = []
             trips[start_time].append({
-                'stop_times_i': trip['cache_indexes']['stop_times_i'],
-                'trip_group_i': trip['cache_indexes']['trip_group_i']
+                'stop_times_i': trip['stop_times_i'],
+                'trip_group_i': trip['trip_group_i']
             })
 
     if len(trips) == 0:
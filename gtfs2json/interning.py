@@ -0,0 +1,34 @@
+"""Intern values into a list and look up their indexes in constant time.
+
+Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
+"""
+
+
+def create(values=None):
+    """Create interning table. Existing list of values is used as is and new values are appended
+    to it, so indexes of values are their indexes in the list (first one wins for duplicates)."""
+    table = {'values': [] if values is None else values, 'indexes': {}}
+    for i, value in enumerate(table['values']):
+        table['indexes'].setdefault(_get_key(value), i)
+    return table
+
+
+def get_index(table, value):
+    """Get index of value in table, value is appended to table if it is not there yet."""
+    key = _get_key(value)
+    if key not in table['indexes']:
+        table['indexes'][key] = len(table['values'])
+        table['values'].append(value)
+    return table['indexes'][key]
+
+
+def find_index(table, value):
+    """Get index of value in table or None if value is not in table."""
+    return table['indexes'].get(_get_key(value))
+
+
+def _get_key(value):
+    """Get hashable key for value, lists (possibly nested) are keyed as tuples."""
+    if isinstance(value, list):
+        return tuple([_get_key(item) for item in value])
+    return value
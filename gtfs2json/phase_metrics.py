@@ -0,0 +1,75 @@
+"""Measure wall time, CPU time, memory and number of processed items of conversion phases.
+
+Metrics of a run are collected into a dict and saved as JSON so that conversion cost can be
+compared across runs and feed versions.
+
+Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
+"""
+
+import contextlib
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+
+def create(name, is_process_wide=True, **info):
+    """Create metrics of run, info is saved as is. Without is_process_wide CPU time and memory of
+    process are not saved (run shares process with other runs)."""
+    return {'name': name, 'start_time': int(time.time()), 'info': info, 'phases': [],
+            '_start_wall_time': time.perf_counter(), '_is_process_wide': is_process_wide}
+
+
+@contextlib.contextmanager
+def measure(metrics, name):
+    """Measure phase of run. Yielded dict of phase can be updated with 'count' of processed rows
+    or objects. Nothing is saved if metrics is None. CPU time of child processes is included after
+    they have been waited for. If tracemalloc is tracing, its peak is saved too (and reset)."""
+    phase = {'name': name, 'count': None}
+    start_wall_time = time.perf_counter()
+    start_cpu_time = _get_cpu_time()
+    start_max_rss = _get_max_rss_mb()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    yield phase
+    if metrics is not None:
+        phase['seconds'] = round(time.perf_counter() - start_wall_time, 3)
+        if metrics['_is_process_wide']:
+            phase['cpu_seconds'] = round(_get_cpu_time() - start_cpu_time, 3)
+            phase['max_rss_mb'] = _get_max_rss_mb()
+            phase['max_rss_delta_mb'] = round(phase['max_rss_mb'] - start_max_rss, 1)
+        if tracemalloc.is_tracing():
+            phase['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        metrics['phases'].append(phase)
+
+
+def add_child_usage(phase, rusage):
+    """Add CPU time and maximum memory of child process (rusage of os.wait4()) into phase."""
+    phase['child_cpu_seconds'] = round(rusage.ru_utime + rusage.ru_stime, 3)
+    phase['child_max_rss_mb'] = round(rusage.ru_maxrss / 1024, 1)
+
+
+def _get_cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _get_max_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def get_summary(metrics):
+    """Get metrics with total wall time and maximum memory of run."""
+    summary = {key: value for key, value in metrics.items() if not key.startswith('_')}
+    summary['seconds'] = round(time.perf_counter() - metrics['_start_wall_time'], 3)
+    if metrics['_is_process_wide']:
+        summary['cpu_seconds'] = round(_get_cpu_time(), 3)
+        summary['max_rss_mb'] = _get_max_rss_mb()
+    return summary
+
+
+def save(metrics, filename):
+    """Save metrics with totals (see get_summary()) into JSON file."""
+    with open(filename, 'w') as output_file:
+        json.dump(get_summary(metrics), output_file, indent=2)
@@ -1,8 +1,9 @@
-"""Encode list of points ((lat,lng) tuples) into string.
+"""Encode list of points ((lat,lng) tuples) into string and decode it.
 
 Author: Panu Ranta, panu.ranta@iki.fi, https://14142.net/kartalla/about.html
 """
 
+import bisect
 import math
 import sys
 
@@ -52,19 +53,15 @@ def _dp_encode(points, very_small):
     dropped_indexes = [True] * len(points)
 
     if len(points) > 2:
+        lats = [point[0] for point in points]
+        lngs = [point[1] for point in points]
         stack.append([0, len(points) - 1])
         while len(stack) > 0:
             current = stack.pop()
-            max_dist = 0
-            seg_len = (math.pow(points[current[1]][0] - points[current[0]][0], 2) +
-                       math.pow(points[current[1]][1] - points[current[0]][1], 2))
-            for i in range(current[0] + 1, current[1]):
-                distance = _distance(points[i], points[current[0]], points[current[1]], seg_len)
-                if distance > max_dist:
-                    max_dist = distance
-                    max_loc = i
-
+            distances = _get_distances(lats, lngs, current[0], current[1])
+            max_dist = max(distances, default=0)
             if max_dist > very_small:
+                max_loc = current[0] + 1 + distances.index(max_dist)  # first of equal distances
                 dropped_indexes[max_loc] = False
                 stack.append([current[0], max_loc])
                 stack.append([max_loc, current[1]])
@@ -72,23 +69,31 @@ def _dp_encode(points, very_small):
     return dropped_indexes
 
 
-def _distance(point0, point1, point2, seg_len):
-    """Compute distance between point0 and segment [point1, point2]. Based on Mark McClure's
-    PolylineEncoder.js."""
-    if (point1[0] == point2[0]) and (point1[1] == point2[1]):
-        out = _dist(point0, point2)
-    else:
-        uuu = ((point0[0] - point1[0]) * (point2[0] - point1[0]) +
-               (point0[1] - point1[1]) * (point2[1] - point1[1])) / seg_len
-
+def _get_distances(lats, lngs, first, last):
+    """Compute distances between points (first, last) and segment [first, last] in one pass. Based
+    on Mark McClure's PolylineEncoder.js."""
+    sqrt = math.sqrt
+    (lat1, lng1, lat2, lng2) = (lats[first], lngs[first], lats[last], lngs[last])
+    if (lat1 == lat2) and (lng1 == lng2):
+        return [sqrt((lat2 - lat) * (lat2 - lat) + (lng2 - lng) * (lng2 - lng))
+                for lat, lng in zip(lats[first + 1:last], lngs[first + 1:last])]
+
+    delta_lat = lat2 - lat1
+    delta_lng = lng2 - lng1
+    seg_len = (delta_lat * delta_lat) + (delta_lng * delta_lng)
+    distances = []
+    for lat, lng in zip(lats[first + 1:last], lngs[first + 1:last]):
+        lat_1 = lat - lat1
+        lng_1 = lng - lng1
+        uuu = (lat_1 * delta_lat + lng_1 * delta_lng) / seg_len
         if uuu <= 0:
-            out = _dist(point0, point1)
+            distances.append(sqrt((lat1 - lat) * (lat1 - lat) + (lng1 - lng) * (lng1 - lng)))
         elif uuu >= 1:
-            out = _dist(point0, point2)
+            distances.append(sqrt((lat2 - lat) * (lat2 - lat) + (lng2 - lng) * (lng2 - lng)))
         else:
-            out = math.sqrt(math.pow((point0[0] - point1[0]) - (uuu * (point2[0] - point1[0])), 2) +
-                            math.pow((point0[1] - point1[1]) - (uuu * (point2[1] - point1[1])), 2))
-    return out
+            distances.append(sqrt((lat_1 - uuu * delta_lat) * (lat_1 - uuu * delta_lat) +
+                                  (lng_1 - uuu * delta_lng) * (lng_1 - uuu * delta_lng)))
+    return distances
 
 
 def _dist(point1, point2):
@@ -135,8 +140,29 @@ def _encode_signed_number(num):
     return _encode_number(sgn_num)
 
 
-def get_point_index(points, point, previous_index):
-    """Find index of the point in points that is closest to point after previous_index."""
+def decode_deltas(encoded_points):
+    """Decode Google's encoded polyline format into list of integers: latitude and longitude
+    differences (in 1e-5 degrees) of each point to previous point."""
+    deltas = []
+    num = 0
+    shift = 0
+    for char in encoded_points:
+        value = ord(char) - 63
+        num |= (value & 0x1F) << shift
+        shift += 5
+        if value < 0x20:
+            deltas.append(~(num >> 1) if (num & 1) else (num >> 1))
+            num = 0
+            shift = 0
+    return deltas
+
+
+def get_point_index(points, point, previous_index, point_index=None):
+    """Find index of the point in points that is closest to point after previous_index. Optional
+    point_index (see create_point_index()) makes the search faster but does not change the
+    result."""
+    if point_index is not None:
+        return _get_indexed_point_index(points, point, previous_index, point_index)
     min_dist = {'i': None, 'v': sys.maxsize}
     for i in range(previous_index, len(points)):
         dist = _dist(points[i], point)
@@ -144,3 +170,72 @@ def get_point_index(points, point, previous_index):
             min_dist['i'] = i
             min_dist['v'] = dist
     return min_dist['i']
+
+
+def create_point_index(points, points_per_cell=4):
+    """Create grid of points for get_point_index(). Returns None if points are too few or all in
+    one place."""
+    if len(points) < 2:
+        return None
+    length = 0
+    for i in range(1, len(points)):
+        length += _dist(points[i - 1], points[i])
+    cell_size = points_per_cell * length / len(points)
+    if cell_size == 0:
+        return None
+
+    cells = {}  # point indexes in ascending order by (x, y) cell
+    for i, point in enumerate(points):
+        cell = _get_cell(point, cell_size)
+        if cell not in cells:
+            cells[cell] = []
+        cells[cell].append(i)
+
+    return {'cell_size': cell_size, 'cells': cells,
+            'min_cell': (min(x for x, _ in cells), min(y for _, y in cells)),
+            'max_cell': (max(x for x, _ in cells), max(y for _, y in cells))}
+
+
+def _get_cell(point, cell_size):
+    return (int(math.floor(point[0] / cell_size)), int(math.floor(point[1] / cell_size)))
+
+
+def _get_indexed_point_index(points, point, previous_index, point_index):
+    """Search rings of cells around point until no closer point can be outside of them. Among
+    equally close points the one with the smallest index wins, as in the linear search."""
+    cell_size = point_index['cell_size']
+    (center_x, center_y) = _get_cell(point, cell_size)
+    max_radius = max(center_x - point_index['min_cell'][0], point_index['max_cell'][0] - center_x,
+                     center_y - point_index['min_cell'][1], point_index['max_cell'][1] - center_y)
+    min_dist = {'i': None, 'v': sys.maxsize}
+    num_visited_cells = 0
+
+    for radius in range(max(0, max_radius) + 1):
+        for cell in _get_ring_cells(center_x, center_y, radius):
+            num_visited_cells += 1
+            cell_indexes = point_index['cells'].get(cell, [])
+            for i in cell_indexes[bisect.bisect_left(cell_indexes, previous_index):]:
+                dist = _dist(points[i], point)
+                if (dist < min_dist['v']) or ((dist == min_dist['v']) and (i < min_dist['i'])):
+                    min_dist['i'] = i
+                    min_dist['v'] = dist
+        # points outside of the ring are at least (radius * cell_size) away, one ring of margin
+        if (min_dist['i'] is not None) and (min_dist['v'] < ((radius - 1) * cell_size)):
+            break
+        if num_visited_cells > (len(points) - previous_index):
+            return get_point_index(points, point, previous_index)  # linear search is cheaper
+
+    return min_dist['i']
+
+
+def _get_ring_cells(center_x, center_y, radius):
+    if radius == 0:
+        return [(center_x, center_y)]
+    ring_cells = []
+    for x in range(center_x - radius, center_x + radius + 1):
+        ring_cells.append((x, center_y - radius))
+        ring_cells.append((x, center_y + radius))
+    for y in range(center_y - radius + 1, center_y + radius):
+        ring_cells.append((center_x - radius, y))
+        ring_cells.append((center_x + radius, y))
+    return ring_cells
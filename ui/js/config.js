@@ -23,6 +23,7 @@ function Config(utils) {
     this.visibleTypes = getVisibleTypes();
     this.onlyRoutes = getOnlyRoutes();
     this.jsonUrl = getJsonUrl(urlParams._file);
+    this.isBinaryUsed = getIsBinaryUsed(urlParams._file);
     this.isAlertsUsed = getIsAlertsUsed(urlParams.alerts);
     this.isVpUsed = getIsVpUsed(urlParams.vp);
 
@@ -34,6 +35,7 @@ function Config(utils) {
         that.vehicleTypes = getVehicleTypes();
         that.visibleTypes = getVisibleTypes();
         that.jsonUrl = getJsonUrl(undefined);
+        that.isBinaryUsed = getIsBinaryUsed(undefined);
         that.isAlertsUsed = getIsAlertsUsed(urlParams.alerts);
         that.isVpUsed = getIsVpUsed(urlParams.vp);
     };
@@ -251,6 +253,13 @@ function Config(utils) {
         }
     }
 
+    // binary data is downloaded only if it exists and browser can decode it
+    function getIsBinaryUsed(urlParamsFile) {
+        return ((urlParamsFile === undefined) &&
+                (configGtfs.getConfig(that.dataType)['binary'] === true) &&
+                (window.TextDecoder !== undefined));
+    }
+
     function getIsAlertsUsed(urlParamsAlers) {
         if (configGtfs.getConfig(that.dataType)['alerts']) {
             return urlParamsAlers !== '0';
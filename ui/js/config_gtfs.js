@@ -3,6 +3,7 @@
 'use strict';
 
 function ConfigGtfs() {
+    // optional 'binary': true if binary data (.bin) is generated too (gtfs2json.py --binary)
     var configList = [
         {'name': 'HSL', 'file': 'hsl', 'dir': 'hsl',
          'lat': 60.302709, 'lng': 24.940832, 'zl': 10, 'alerts': true, 'vp': true,
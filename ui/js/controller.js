@@ -2,7 +2,7 @@
 
 'use strict';
 
-function Controller(gtfs, map) {
+function Controller(gtfs, map, tripBucketHandler) {
     var that = this;
     var state = getState();
 
@@ -128,6 +128,11 @@ function Controller(gtfs, map) {
         state.tripTypeInfos.refreshStatistics();
     }
 
+    // find active trips of new routes or trip buckets at next update
+    this.routesAreAdded = function () {
+        state.nextTripUpdate = 0;
+    };
+
     this.updateTripTypeVisibility = function (tripTypeName) {
         for (var tripId in state.activeTrips) {
             if (state.activeTrips[tripId].getType() === tripTypeName) {
@@ -149,13 +154,20 @@ function Controller(gtfs, map) {
 
     function updateActiveTrips(dateString, mapDate,
                                updatePeriodInMinutes, isAfterMidnight) { // dateString = YYYYMMDD
+        var fromMinutesAfterMidnight = getMinutesAfterMidnight(mapDate);
+        if (isAfterMidnight) {
+            /* GTFS clock does not wrap around after 24 hours (or 24 * 60 = 1440 minutes) */
+            fromMinutesAfterMidnight += 24 * 60;
+        }
+        var toMinutesAfterMidnight = fromMinutesAfterMidnight + updatePeriodInMinutes;
+        tripBucketHandler(fromMinutesAfterMidnight, toMinutesAfterMidnight);
         var numNewTrips = 0;
         var routes = gtfs.getRoutes();
         for (var i = 0; i < routes.length; i++) {
             if ((state.onlyRoutes === null) ||
                 (state.onlyRoutes.indexOf(routes[i].getName()) !== -1)) {
-                var activeTrips = getActiveTrips(routes[i], dateString, mapDate,
-                                                 updatePeriodInMinutes, isAfterMidnight);
+                var activeTrips = routes[i].getActiveTrips(dateString, fromMinutesAfterMidnight,
+                                                           toMinutesAfterMidnight);
                 for (var j = 0; j < activeTrips.length; j++) {
                     var tripId = activeTrips[j].getId();
                     if (state.activeTrips[tripId] === undefined) {
@@ -172,17 +184,6 @@ function Controller(gtfs, map) {
         console.log('found %d new active trips for %s', numNewTrips, mapDate.toLocaleString());
     }
 
-    function getActiveTrips(gtfsRoute, dateString, mapDate,
-                            updatePeriodInMinutes, isAfterMidnight) { // dateString = YYYYMMDD
-        var fromMinutesAfterMidnight = getMinutesAfterMidnight(mapDate);
-        if (isAfterMidnight) {
-            /* GTFS clock does not wrap around after 24 hours (or 24 * 60 = 1440 minutes) */
-            fromMinutesAfterMidnight += 24 * 60;
-        }
-        return gtfsRoute.getActiveTrips(dateString, fromMinutesAfterMidnight,
-            fromMinutesAfterMidnight + updatePeriodInMinutes);
-    };
-
     function getMinutesAfterMidnight(date) {
         return (date.getHours() * 60) + date.getMinutes(); // possible values: 0 - 1439
     }
@@ -10,12 +10,108 @@ function Gtfs() {
         var s = {};
         s.root = null;
         s.arrayKeys = null;
+        s.routes = null;
+        s.shardStates = null; // key: shard filename, value: 'requested' or 'added'
+        s.tripBucketStates = null; // key: trip bucket filename, value: 'requested' or 'added'
+        s.tripSlices = null; // key: route id, value: trip slices of added buckets by direction
+        s.sharedIntegerLists = null; // key: value name, value: decoded lists by table index
         return s;
     }
 
     this.init = function (jsonData) {
         state.root = jsonData;
         state.arrayKeys = state.root[0];
+        state.shardStates = {};
+        state.tripBucketStates = {};
+        state.tripSlices = {};
+        state.sharedIntegerLists = {'stop_distances': [], 'stop_times': []};
+        if (that.isSharded()) {
+            state.routes = []; // routes are added from shards by addShard()
+        } else {
+            state.routes = state.root[getArrayKey('routes')];
+        }
+    };
+
+    // JSON data is a manifest if routes are in shard files (one route type per shard).
+    this.isSharded = function () {
+        return (state.root !== null) && (getArrayKey('shards') !== undefined);
+    };
+
+    // Get filenames of shards of given route types (e.g. ['bus', 'tram']) not requested yet.
+    this.getNewShardFilenames = function (routeTypes) {
+        var filenames = [];
+        var shards = state.root[getArrayKey('shards')];
+        for (var i = 0; i < shards.length; i++) {
+            var filename = shards[i][that.getArrayKeys('shard')['filename']];
+            var routeType = shards[i][that.getArrayKeys('shard')['type']];
+            if ((routeTypes.indexOf(routeType) !== -1) &&
+                (state.shardStates[filename] === undefined)) {
+                state.shardStates[filename] = 'requested';
+                filenames.push(filename);
+            }
+        }
+        return filenames;
+    };
+
+    // Add routes of requested shard, return false if shard was not requested (e.g. after init).
+    this.addShard = function (filename, shardRoutes) {
+        if (state.shardStates[filename] !== 'requested') {
+            return false;
+        }
+        state.shardStates[filename] = 'added';
+        state.routes = state.routes.concat(shardRoutes);
+        return true;
+    };
+
+    // Trips are in bucket files by start time if root has trip buckets.
+    this.isTripBucketed = function () {
+        return (state.root !== null) && (getArrayKey('trip_buckets') !== undefined);
+    };
+
+    /* Get filenames of trip buckets with trips running between from and to, and of the next
+    bucket after to (prefetch), not requested yet. */
+    this.getNewTripBucketFilenames = function (fromMinutesAfterMidnight,
+                                               toMinutesAfterMidnight) {
+        var filenames = [];
+        var tripBuckets = state.root[getArrayKey('trip_buckets')];
+        var isNextBucket = false;
+        for (var i = 0; (i < tripBuckets.length) && !isNextBucket; i++) {
+            var filename = tripBuckets[i][that.getArrayKeys('trip_bucket')['filename']];
+            var startTime = tripBuckets[i][that.getArrayKeys('trip_bucket')['start_time']];
+            var endTime = tripBuckets[i][that.getArrayKeys('trip_bucket')['end_time']];
+            isNextBucket = startTime > toMinutesAfterMidnight;
+            if ((isNextBucket || (endTime > fromMinutesAfterMidnight)) &&
+                (state.tripBucketStates[filename] === undefined)) {
+                state.tripBucketStates[filename] = 'requested';
+                filenames.push(filename);
+            }
+        }
+        return filenames;
+    };
+
+    // Add trip slices of requested bucket, return false if bucket was not requested.
+    this.addTripBucket = function (filename, tripSlices) {
+        if (state.tripBucketStates[filename] !== 'requested') {
+            return false;
+        }
+        state.tripBucketStates[filename] = 'added';
+        var tripSliceKeys = that.getArrayKeys('trip_slice');
+        for (var i = 0; i < tripSlices.length; i++) {
+            var routeId = tripSlices[i][tripSliceKeys['route_id']];
+            var directionIndex = tripSlices[i][tripSliceKeys['direction_i']];
+            if (state.tripSlices[routeId] === undefined) {
+                state.tripSlices[routeId] = [[], []];
+            }
+            state.tripSlices[routeId][directionIndex].push(tripSlices[i]);
+        }
+        return true;
+    };
+
+    this.getTripSlices = function (routeId, directionIndex) {
+        if (state.tripSlices[routeId] === undefined) {
+            return [];
+        }
+        return state.tripSlices[routeId][directionIndex];
     };
 
     this.getArrayKeys = function (node) {
@@ -42,19 +138,36 @@ function Gtfs() {
         return state.root[getArrayKey('dates')];
     };
 
+    // Routes have indexes of shared string tables of root instead of strings if root has tables
+    // (gtfs2json.py --shared-strings).
+    this.isSharedStrings = function () {
+        return getArrayKey('shapes') !== undefined;
+    };
+
+    this.getSharedString = function (valueName, tableIndex) {
+        return state.root[getArrayKey(valueName)][tableIndex];
+    };
+
+    // Delta lists of shared table are unpacked only once as they are shared by many routes.
+    this.getSharedDeltaList = function (valueName, tableIndex) {
+        var integerLists = state.sharedIntegerLists[valueName];
+        if (integerLists[tableIndex] === undefined) {
+            var packedDeltaList = that.getSharedString(valueName, tableIndex);
+            integerLists[tableIndex] =
+                that.unpackDeltaList(that.toIntegerList(packedDeltaList));
+        }
+        return integerLists[tableIndex];
+    };
+
     this.getRoutes = function () {
         var routes = [];
-        for (var i = 0; i < state.root[getArrayKey('routes')].length; i++) {
-            var route = new GtfsRoute(i, that, getRootRoute(i));
+        for (var i = 0; i < state.routes.length; i++) {
+            var route = new GtfsRoute(i, that, state.routes[i]);
             routes.push(route);
         }
         return routes;
     };
 
-    function getRootRoute(routeIndex) {
-        return state.root[getArrayKey('routes')][routeIndex];
-    }
-
     // For '#$%1~!$2!~!!$3' return [0, 1, 2, 14, 91, 92, 15, 182, 183, 16].
     this.stringToIntegerList = function (string) {
         var integerList = [];
@@ -76,6 +189,15 @@ function Gtfs() {
         return integerList;
     };
 
+    // Packed integer list is a string in JSON data and Int32Array in binary data.
+    this.toIntegerList = function (packedIntegerList) {
+        if (typeof packedIntegerList === 'string') {
+            return that.stringToIntegerList(packedIntegerList);
+        } else {
+            return packedIntegerList;
+        }
+    };
+
     // For [10, 1, 11, 3] return [0, 10, 11, 22, 25]
     this.unpackDeltaList = function (integerList) {
         var unpackedList = [0];
@@ -86,6 +208,124 @@ function Gtfs() {
     };
 }
 
+/* Decode binary data written by gtfs2json/binary_format.py into same structure as JSON data
+except that packed integer lists and encoded shapes (latitude and longitude deltas in 1e-5
+degrees) are Int32Arrays. Return null if data is not binary data of supported version. */
+function decodeGtfsBinary(arrayBuffer) {
+    var tags = {'null': 0, 'false': 1, 'true': 2, 'integer': 3, 'float': 4, 'string': 5,
+                'list': 6, 'openList': 7, 'end': 8, 'dict': 9, 'integerArray': 10};
+    if (!(arrayBuffer instanceof ArrayBuffer)) {
+        return null;
+    }
+    var bytes = new Uint8Array(arrayBuffer);
+    var view = new DataView(arrayBuffer);
+    var headerSize = 9;
+    if ((bytes.length < headerSize) ||
+        (String.fromCharCode(bytes[0], bytes[1], bytes[2], bytes[3]) !== 'GTFB') ||
+        (bytes[4] !== 1)) {
+        return null;
+    }
+    var position = view.getUint32(5, true);
+    var strings = readStrings();
+    position = headerSize;
+    return readValue();
+
+    function readStrings() {
+        var decoder = new TextDecoder('utf-8');
+        var stringList = [];
+        var numStrings = readVarint();
+        for (var i = 0; i < numStrings; i++) {
+            var length = readVarint();
+            stringList.push(decoder.decode(bytes.subarray(position, position + length)));
+            position += length;
+        }
+        return stringList;
+    }
+
+    function readVarint() {
+        var value = 0;
+        var multiplier = 1;
+        var b;
+        do {
+            b = bytes[position++];
+            value += (b & 0x7f) * multiplier;
+            multiplier *= 128;
+        } while (b >= 0x80);
+        return value;
+    }
+
+    // faster than readZigzag() but only for values of 32-bit signed integer
+    function readInt32Zigzag() {
+        var b = bytes[position++];
+        var value = b & 0x7f;
+        var shift = 7;
+        while (b >= 0x80) {
+            b = bytes[position++];
+            value |= (b & 0x7f) << shift;
+            shift += 7;
+        }
+        return (value >>> 1) ^ -(value & 1);
+    }
+
+    function readZigzag() {
+        var value = readVarint();
+        return ((value % 2) === 0) ? (value / 2) : -((value + 1) / 2);
+    }
+
+    function readValue() {
+        var tag = bytes[position++];
+        var i;
+        var values;
+        var length;
+        switch (tag) {
+        case tags.integer:
+            return readZigzag();
+        case tags.string:
+            return strings[readVarint()];
+        case tags.list:
+            length = readVarint();
+            values = [];
+            for (i = 0; i < length; i++) {
+                values.push(readValue());
+            }
+            return values;
+        case tags.openList:
+            values = [];
+            while (bytes[position] !== tags.end) {
+                values.push(readValue());
+            }
+            position += 1;
+            return values;
+        case tags.dict:
+            length = readVarint();
+            values = {};
+            for (i = 0; i < length; i++) {
+                var key = strings[readVarint()];
+                values[key] = readValue();
+            }
+            return values;
+        case tags.integerArray:
+            length = readVarint();
+            values = new Int32Array(length);
+            for (i = 0; i < length; i++) {
+                values[i] = readInt32Zigzag();
+            }
+            return values;
+        case tags.float:
+            position += 8;
+            return view.getFloat64(position - 8, true);
+        case tags.null:
+            return null;
+        case tags.false:
+            return false;
+        case tags.true:
+            return true;
+        default:
+            throw new Error('unknown tag ' + tag + ' at ' + (position - 1));
+        }
+    }
+}
+
 function GtfsRoute(routeId, gtfsRoot, rootRoute) {
     var that = this;
 
@@ -114,12 +354,19 @@ function GtfsRoute(routeId, gtfsRoot, rootRoute) {
     };
 
     this.getShape = function (shapeIndex) {
-        return rootRoute[getArrayKey('shapes')][shapeIndex];
+        var shape = rootRoute[getArrayKey('shapes')][shapeIndex];
+        if (gtfsRoot.isSharedStrings()) {
+            return gtfsRoot.getSharedString('shapes', shape);
+        }
+        return shape;
     };
 
     this.getStopDistances = function (stopDistancesIndex) {
-        var stopDistancesString = rootRoute[getArrayKey('stop_distances')][stopDistancesIndex];
-        return gtfsRoot.unpackDeltaList(gtfsRoot.stringToIntegerList(stopDistancesString));
+        var stopDistances = rootRoute[getArrayKey('stop_distances')][stopDistancesIndex];
+        if (gtfsRoot.isSharedStrings()) {
+            return gtfsRoot.getSharedDeltaList('stop_distances', stopDistances);
+        }
+        return gtfsRoot.unpackDeltaList(gtfsRoot.toIntegerList(stopDistances));
     };
 
     this.getTripDates = function (tripDatesIndex) {
@@ -151,10 +398,17 @@ function GtfsRoute(routeId, gtfsRoot, rootRoute) {
         var activeTrips = [];
         var directions = getDirections();
         for (var i = 0; i < directions.length; i++) {
+            if (gtfsRoot.isTripBucketed()) {
+                activeTrips = activeTrips.concat(getActiveSlicedTrips(i,
+                    gtfsRoot.getTripSlices(that.getRouteId(), i), dateString,
+                    fromMinutesAfterMidnight, toMinutesAfterMidnight));
+                continue;
+            }
             var trips = directions[i][gtfsRoot.getArrayKeys('direction')['trips']];
             if (trips.length > 0) { // some routes have only direction 1
                 activeTrips = activeTrips.concat(getActiveDirectionTrips(i, trips, dateString,
-                                                 fromMinutesAfterMidnight, toMinutesAfterMidnight));
+                                                 fromMinutesAfterMidnight, toMinutesAfterMidnight,
+                                                 0));
             }
         }
         return activeTrips;
@@ -164,16 +418,38 @@ function GtfsRoute(routeId, gtfsRoot, rootRoute) {
         return gtfsRoot.getArrayKeys('trip')[keyId];
     }
 
+    function getTripSliceArrayKey(keyId) {
+        return gtfsRoot.getArrayKeys('trip_slice')[keyId];
+    }
+
+    // only slices of added trip buckets with trips running between from and to are decoded
+    function getActiveSlicedTrips(directionIndex, tripSlices, dateString,
+                                  fromMinutesAfterMidnight, toMinutesAfterMidnight) {
+        var activeTrips = [];
+        for (var i = 0; i < tripSlices.length; i++) {
+            var tripSlice = tripSlices[i];
+            if ((tripSlice[getTripSliceArrayKey('start_time')] <= toMinutesAfterMidnight) &&
+                (tripSlice[getTripSliceArrayKey('end_time')] > fromMinutesAfterMidnight)) {
+                activeTrips = activeTrips.concat(getActiveDirectionTrips(directionIndex,
+                    tripSlice[getTripSliceArrayKey('trips')], dateString,
+                    fromMinutesAfterMidnight, toMinutesAfterMidnight,
+                    tripSlice[getTripSliceArrayKey('first_trip_i')]));
+            }
+        }
+        return activeTrips;
+    }
+
     function getActiveDirectionTrips(directionIndex, directionTrips, dateString,
-                                     fromMinutesAfterMidnight, toMinutesAfterMidnight) {
+                                     fromMinutesAfterMidnight, toMinutesAfterMidnight,
+                                     firstTripIndex) {
         var firstStartTime = directionTrips[getTripArrayKey('first_start_time')];
         var startTimesString = directionTrips[getTripArrayKey('start_times')];
         var startTimes =
-            gtfsRoot.unpackDeltaList(gtfsRoot.stringToIntegerList(startTimesString));
+            gtfsRoot.unpackDeltaList(gtfsRoot.toIntegerList(startTimesString));
         var stopTimesIndexesString = directionTrips[getTripArrayKey('stop_times_indexes')];
-        var stopTimesIndexes = gtfsRoot.stringToIntegerList(stopTimesIndexesString);
+        var stopTimesIndexes = gtfsRoot.toIntegerList(stopTimesIndexesString);
         var tripGroupIndexesString = directionTrips[getTripArrayKey('trip_group_indexes')];
-        var tripGroupIndexes = gtfsRoot.stringToIntegerList(tripGroupIndexesString);
+        var tripGroupIndexes = gtfsRoot.toIntegerList(tripGroupIndexesString);
 
         var activeTrips = [];
         for (var i = 0; i < startTimes.length; i++) {
@@ -182,8 +458,8 @@ function GtfsRoute(routeId, gtfsRoot, rootRoute) {
             if ((startTime <= toMinutesAfterMidnight) &&
                 ((startTime + stopTimes[stopTimes.length - 1]) > fromMinutesAfterMidnight)) {
                 var tripGroup = getTripGroup(tripGroupIndexes[i]);
-                var trip = new GtfsTrip(i, gtfsRoot, that, directionIndex, startTime, stopTimes,
-                                        tripGroup);
+                var trip = new GtfsTrip(firstTripIndex + i, gtfsRoot, that, directionIndex,
+                                        startTime, stopTimes, tripGroup);
                 if (trip.isActive(dateString)) {
                     activeTrips.push(trip);
                 }
@@ -194,8 +470,12 @@ function GtfsRoute(routeId, gtfsRoot, rootRoute) {
 
     function getTripStopTimes(stopTimesI) {
         var isDepartureTimes = getIsDepartureTimes();
-        var stopTimeDeltas = gtfsRoot.stringToIntegerList(getStopTimes(stopTimesI));
-        var stopTimes = gtfsRoot.unpackDeltaList(stopTimeDeltas);
+        var stopTimes;
+        if (gtfsRoot.isSharedStrings()) {
+            stopTimes = gtfsRoot.getSharedDeltaList('stop_times', getStopTimes(stopTimesI));
+        } else {
+            stopTimes = gtfsRoot.unpackDeltaList(gtfsRoot.toIntegerList(getStopTimes(stopTimesI)));
+        }
         if (isDepartureTimes === 0) {
             stopTimes = addDepartureTimes(stopTimes);
         }
@@ -271,6 +551,9 @@ function GtfsTrip(tripId, gtfsRoot, gtfsRoute, directionIndex, startTime, stopTi
     }
 
     this.isActive = function (dateString) { // dateString = YYYYMMDD
+        if (getTripDatesArrayKey('active_days') !== undefined) {
+            return isActiveDay(dateString);
+        }
         var exceptionDates = getExceptionDates();
 
         if (exceptionDates.added.indexOf(dateString) !== -1) {
@@ -286,6 +569,26 @@ function GtfsTrip(tripId, gtfsRoot, gtfsRoute, directionIndex, startTime, stopTi
         }
     };
 
+    /* Bit i of active days (six bits in each character) is set if trip is active i days after
+    start day. */
+    function isActiveDay(dateString) { // dateString = YYYYMMDD
+        var bitmapChars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/';
+        var activeDays = getTripDates()[getTripDatesArrayKey('active_days')];
+        var dayIndex = getDayNumber(dateString) - getDayNumber(getStartDay());
+        var charIndex = Math.floor(dayIndex / 6);
+        if ((dayIndex < 0) || (charIndex >= activeDays.length)) {
+            return false;
+        }
+        var bits = bitmapChars.indexOf(activeDays.charAt(charIndex));
+        return (bits & (1 << (dayIndex % 6))) !== 0;
+    }
+
+    function getDayNumber(dateString) { // dateString = YYYYMMDD, days since epoch
+        var dayMilliseconds = 24 * 60 * 60 * 1000;
+        return Date.UTC(dateString.substring(0, 4), dateString.substring(4, 6) - 1,
+                        dateString.substring(6, 8)) / dayMilliseconds;
+    }
+
     function getDateWeekDay(dateString) { // dateString = YYYYMMDD
         var date = new Date(dateString.substring(0, 4), dateString.substring(4, 6) - 1,
                             dateString.substring(6, 8));
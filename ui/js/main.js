@@ -9,10 +9,10 @@ function main() {
     var uiBar = new UiBar(utils);
     var map = new CommonMap(utils);
     var gtfs = new Gtfs();
-    var controller = new Controller(gtfs, map);
+    var controller = new Controller(gtfs, map, downloadGtfsTripBuckets);
     var alerts = new HslAlerts(controller, uiBar);
     var timing = new Timing(alerts, controller, uiBar);
-    var tripTypeInfos = new TripTypeInfos(controller, uiBar);
+    var tripTypeInfos = new TripTypeInfos(controller, uiBar, downloadGtfsShards);
     var mqtt = new HslMqtt(utils, controller, uiBar);
 
     tripTypeInfos.init(config.vehicleTypes, config.visibleTypes);
@@ -26,9 +26,10 @@ function main() {
 
     initResizeHandler();
 
-    downloadGtfsJsonData(config.jsonUrl);
+    downloadGtfsJsonData(config.jsonUrl, config.isBinaryUsed);
 
-    function downloadGtfsJsonData(filename) {
+    // binary data (.bin) is downloaded if it is used (see Config), JSON data is the fallback
+    function downloadGtfsJsonData(filename, isBinaryUsed) {
         var readyEventName = 'gtfsDownloadIsReady';
         var readyEvent = document.createEvent('Event');
         readyEvent.initEvent(readyEventName, false, false);
@@ -36,20 +37,47 @@ function main() {
 
         var startTime = new Date();
         var downloadRequest = null;
+        var isBinary = isBinaryUsed;
 
-        utils.downloadUrl(filename, uiBar.updateDownloadProgress, function (request) {
+        if (isBinary) {
+            utils.downloadUrl(filename.replace(/\.json$/, '.bin'), uiBar.updateDownloadProgress,
+                              downloadIsDone, 'arraybuffer', downloadJson);
+        } else {
+            downloadJson();
+        }
+
+        function downloadJson() {
+            isBinary = false;
+            utils.downloadUrl(filename, uiBar.updateDownloadProgress, downloadIsDone);
+        }
+
+        function downloadIsDone(request) {
             downloadRequest = request;
             document.dispatchEvent(readyEvent);
-        });
+        }
 
         function downloadIsReady() {
+            var gtfsData = null;
+            var dataSize = null;
+            if (isBinary) {
+                gtfsData = decodeGtfsBinary(downloadRequest.response);
+                if (gtfsData === null) {
+                    console.error('invalid binary data, downloading JSON data');
+                    downloadJson();
+                    return;
+                }
+                dataSize = downloadRequest.response.byteLength;
+            } else {
+                gtfsData = JSON.parse(downloadRequest.responseText);
+                dataSize = downloadRequest.responseText.length;
+            }
             document.removeEventListener(readyEventName, downloadIsReady, false);
             var duration = (((new Date()).getTime() - startTime.getTime()) / 1000).toFixed(1);
-            gtfs.init(JSON.parse(downloadRequest.responseText));
-            uiBar.setDataInfo(gtfs.getGtfsEpoch(), gtfs.getJsonEpoch(),
-                              downloadRequest.responseText.length, duration,
+            gtfs.init(gtfsData);
+            uiBar.setDataInfo(gtfs.getGtfsEpoch(), gtfs.getJsonEpoch(), dataSize, duration,
                               isDownloadCompressed(), mqtt.getDataCount);
             timing.downloadIsReady();
+            downloadGtfsShards();
             window.onresize();
             if (mqtt.isVpUsed()) {
                 mqtt.connect();
@@ -62,6 +90,60 @@ function main() {
         }
     }
 
+    // download shards of visible trip types not downloaded yet if JSON data is a manifest
+    function downloadGtfsShards() {
+        if (gtfs.isSharded()) {
+            var baseUrl = getJsonBaseUrl();
+            var filenames = gtfs.getNewShardFilenames(getVisibleTripTypeNames());
+            for (var i = 0; i < filenames.length; i++) {
+                downloadGtfsShard(baseUrl, filenames[i]);
+            }
+        }
+    }
+
+    function downloadGtfsShard(baseUrl, filename) {
+        utils.downloadUrl(baseUrl + filename, function () {}, function (request) {
+            if (gtfs.addShard(filename, JSON.parse(request.responseText))) {
+                controller.routesAreAdded();
+            }
+        });
+    }
+
+    // download trip buckets of time window (minutes after midnight) not downloaded yet
+    function downloadGtfsTripBuckets(fromMinutesAfterMidnight, toMinutesAfterMidnight) {
+        if (gtfs.isTripBucketed()) {
+            var baseUrl = getJsonBaseUrl();
+            var filenames = gtfs.getNewTripBucketFilenames(fromMinutesAfterMidnight,
+                                                           toMinutesAfterMidnight);
+            for (var i = 0; i < filenames.length; i++) {
+                downloadGtfsTripBucket(baseUrl, filenames[i]);
+            }
+        }
+    }
+
+    function downloadGtfsTripBucket(baseUrl, filename) {
+        utils.downloadUrl(baseUrl + filename, function () {}, function (request) {
+            if (gtfs.addTripBucket(filename, JSON.parse(request.responseText))) {
+                controller.routesAreAdded();
+            }
+        });
+    }
+
+    function getJsonBaseUrl() {
+        return config.jsonUrl.substring(0, config.jsonUrl.lastIndexOf('/') + 1);
+    }
+
+    function getVisibleTripTypeNames() {
+        var tripTypeNames = [];
+        var tripTypes = tripTypeInfos.getTypes();
+        for (var tripTypeName in tripTypes) {
+            if (tripTypes[tripTypeName].isUsed && tripTypes[tripTypeName].isVisible) {
+                tripTypeNames.push(tripTypeName);
+            }
+        }
+        return tripTypeNames;
+    }
+
     function initResizeHandler() {
         window.onresize = resizeMap;
 
@@ -99,7 +181,7 @@ function main() {
                 timing.restart();
                 map.restart(config.mapLat, config.mapLng, config.mapZoomLevel);
                 window.onresize();
-                downloadGtfsJsonData(config.jsonUrl);
+                downloadGtfsJsonData(config.jsonUrl, config.isBinaryUsed);
             }
         };
     }
@@ -192,7 +274,7 @@ function Timing(alerts, controller, uiBar) {
     };
 }
 
-function TripTypeInfos(controller, uiBar) {
+function TripTypeInfos(controller, uiBar, visibilityHandler) {
     var that = this;
     var state = getState();
 
@@ -252,5 +334,6 @@ function TripTypeInfos(controller, uiBar) {
     this.toggleVisibility = function (tripTypeName) {
         state.types[tripTypeName].isVisible = !state.types[tripTypeName].isVisible;
         controller.updateTripTypeVisibility(tripTypeName);
+        visibilityHandler();
     };
 }
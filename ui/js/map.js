@@ -122,8 +122,13 @@ function CommonMap(utils) {
         state.maMap.resize(newHeight);
     };
 
+    // encodedPath is encoded polyline string (JSON data) or Int32Array (binary data)
     this.decodePath = function (encodedPath) {
-        return state.maMap.decodePath(encodedPath);
+        if (typeof encodedPath === 'string') {
+            return state.maMap.decodePath(encodedPath);
+        } else {
+            return state.maMap.decodeDeltaPath(encodedPath);
+        }
     };
 
     // path as returned by decodePath()
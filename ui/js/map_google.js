@@ -80,6 +80,19 @@ function MapApiMap() {
         return google.maps.geometry.encoding.decodePath(encodedPath);
     };
 
+    // Decode latitude and longitude deltas (in 1e-5 degrees) into a list of LatLng.
+    this.decodeDeltaPath = function (deltas) {
+        var path = [];
+        var lat = 0;
+        var lng = 0;
+        for (var i = 0; i < deltas.length; i += 2) {
+            lat += deltas[i];
+            lng += deltas[i + 1];
+            path.push(new google.maps.LatLng(lat * 1e-5, lng * 1e-5));
+        }
+        return path;
+    };
+
     // path as returned by decodePath()
     this.newPolyline = function (path, polylineOptions) {
         var polyline = new google.maps.Polyline({
@@ -117,6 +117,19 @@ function MapApiMap() {
         return decodeLine(encodedPath);
     };
 
+    // Decode latitude and longitude deltas (in 1e-5 degrees) into a list of latLng.
+    this.decodeDeltaPath = function (deltas) {
+        var path = [];
+        var lat = 0;
+        var lng = 0;
+        for (var i = 0; i < deltas.length; i += 2) {
+            lat += deltas[i];
+            lng += deltas[i + 1];
+            path.push(L.latLng(lat * 1e-5, lng * 1e-5));
+        }
+        return path;
+    };
+
     // http://code.google.com/apis/maps/documentation/utilities/include/polyline.js
     // Decode an encoded polyline into a list of latLng.
     function decodeLine(encoded) {
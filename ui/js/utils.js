@@ -5,24 +5,31 @@
 function Utils() {
     var that = this;
 
-    this.downloadUrl = function (url, progressHandler, responseHandler) {
+    // optional responseType (e.g. 'arraybuffer') and errorHandler (called on unexpected status)
+    this.downloadUrl = function (url, progressHandler, responseHandler, responseType,
+                                 errorHandler) {
         var request = new XMLHttpRequest();
         request.addEventListener('progress', progressHandler);
 
         request.onreadystatechange = function () {
             if (request.readyState === 4) {
                 var status = request.status;
+                request.onreadystatechange = function () {};
                 if ((status === 0) || (status === 200)) {
                     responseHandler(request);
-                    request.onreadystatechange = function () {};
                 } else {
                     console.error('unexpected status: ' + status);
+                    if (errorHandler !== undefined) {
+                        errorHandler(request);
+                    }
                 }
             }
         };
 
         request.open('GET', url, true);
-        if (url.indexOf('.json') !== -1) {
+        if (responseType !== undefined) {
+            request.responseType = responseType;
+        } else if (url.indexOf('.json') !== -1) {
             request.overrideMimeType('application/json');
         }
         request.send();